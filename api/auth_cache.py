@@ -0,0 +1,144 @@
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from .db_conn import get_conn, listen
+
+# Cross-worker invalidation through PostgreSQL LISTEN/NOTIFY. When disabled, the other
+# workers only see a password change once their entry expires, hence the shorter TTL.
+AUTH_CACHE_NOTIFY = os.getenv("AUTH_CACHE_NOTIFY", "true").lower() == "true"
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300" if AUTH_CACHE_NOTIFY else "30"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+NOTIFY_CHANNEL = "password_change"
+
+
+class TTLCache:
+    """
+    Small thread-safe LRU cache whose entries expire after `ttl` seconds
+    """
+
+    def __init__(self, ttl=AUTH_CACHE_TTL, maxsize=AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        # Invalidations per key, and of the whole cache, to spot the ones
+        # happening while a value is being read
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def generation(self, key):
+        with self._lock:
+            return self._epoch, self._generations.get(key, 0)
+
+    def get(self, key):
+        """
+        :return: (hit, value)
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at < monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def put(self, key, value, generation=None):
+        """
+        :param generation: value of `generation(key)` before `value` was read,
+            it isn't stored if the key was invalidated meanwhile
+        """
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(key, 0)):
+                return
+            self._data[key] = (value, monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._generations) >= self.maxsize:
+                self._clear_generations()
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._clear_generations()
+
+    def _clear_generations(self):
+        # A new epoch: the values being read are all dropped
+        self._generations.clear()
+        self._epoch += 1
+
+
+password_changes = TTLCache()
+
+
+class UnknownUser(Exception):
+    pass
+
+
+def get_last_password_change(user_id):
+    """
+    Returns the last password change of a user, from the cache if possible.
+    :param user_id: user id
+    :return: datetime or None
+    :raise UnknownUser: if the user doesn't exist anymore
+    """
+    hit, last_pwd_change = password_changes.get(user_id)
+    if hit:
+        return last_pwd_change
+
+    # A change committed during the SELECT mustn't be hidden for AUTH_CACHE_TTL
+    generation = password_changes.generation(user_id)
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT last_password_change FROM users WHERE id=%s", (user_id,))
+        result = cur.fetchone()
+    if result is None:
+        raise UnknownUser(user_id)
+
+    password_changes.put(user_id, result[0], generation)
+    return result[0]
+
+
+def notify_password_change(cur, user_id):
+    """
+    Tells the other workers to drop their cached entry. To be called in the
+    transaction changing the password: the notification is sent on commit.
+    """
+    if AUTH_CACHE_NOTIFY:
+        cur.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, str(user_id)))
+
+
+def invalidate_password_change(user_id):
+    """
+    Drops the cached entry of a user in this worker, once the change is committed
+    """
+    password_changes.invalidate(user_id)
+
+
+def _on_password_change(payload):
+    try:
+        password_changes.invalidate(int(payload))
+    except ValueError:
+        password_changes.clear()
+
+
+def start_password_change_listener():
+    """
+    Starts the background thread invalidating the cache on other workers'
+    password changes (unless AUTH_CACHE_NOTIFY is disabled).
+    """
+    if not AUTH_CACHE_NOTIFY:
+        return
+    # Notifications may have been missed while disconnected
+    threading.Thread(target=listen, args=(NOTIFY_CHANNEL, _on_password_change, password_changes.clear),
+                     name="password-change-listener", daemon=True).start()
@@ -0,0 +1,103 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .db_conn import get_conn
+from .influx import read_times, recompute_rollups, write_batch_to_influx
+from .metrics import BACKFILLS
+from .query_cache import notify_cgm_write
+from .vendors import HISTORY, VENDORS, reading_fields
+
+logger = logging.getLogger(__name__)
+
+# A gap longer than that between two readings of a connection triggers a backfill
+BACKFILL_GAP = float(os.getenv("BACKFILL_GAP", "900"))
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "2"))
+
+_executor = None
+_lock = threading.Lock()
+_in_flight = set()
+
+
+def make_client(conn_id, vendor):
+    """
+    Builds a client of its own for a backfill, from the session stored for the
+    connection: the client of the poller keeps serving the polling cycles meanwhile.
+    :raise LookupError: if the connection doesn't exist anymore
+    """
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, user_id, username, password, token, type, region, account_id
+            FROM connections WHERE id = %s
+        """, (conn_id,))
+        row = cur.fetchone()
+        columns = [desc[0] for desc in cur.description]
+    if row is None:
+        raise LookupError(f"Connection {conn_id} not found")
+    return VENDORS[vendor][0](dict(zip(columns, row)))
+
+
+def backfill(conn_id, user_id, vendor, client):
+    """
+    Imports the readings history of a connection (24h for Dexcom, 12h for
+    LibreLinkUp) in one vendor call, skipping the readings already stored, and
+    writes it in one batch, then computes again the rollups it changed.
+    :param conn_id: id of the connection
+    :param user_id: owner of the connection
+    :param vendor: connection type (ex: "Dexcom")
+    :param client: logged in or resumable vendor client, not used elsewhere
+        meanwhile; None to build one from the stored session
+    :return: number of readings written
+    """
+    if client is None:
+        client = make_client(conn_id, vendor)
+    readings = HISTORY[vendor](client, conn_id)
+    if not readings:
+        return 0
+
+    stored = read_times(user_id, vendor, start=min(
+        reading.time for reading in readings))
+    missing = {reading.time: reading for reading in readings
+               if reading.time not in stored}
+    write_batch_to_influx(
+        "glucose", {"user_id": user_id, "device": vendor},
+        [(reading_fields(reading), reading.time) for reading in missing.values()])
+    if missing:
+        notify_cgm_write([user_id], reset=True)
+        # Older than the window recomputed by the rollup tasks
+        recompute_rollups(user_id, min(missing))
+    return len(missing)
+
+
+def _run(conn_id, user_id, vendor, client):
+    try:
+        written = backfill(conn_id, user_id, vendor, client)
+        BACKFILLS.labels("ok").inc()
+        if written:
+            logger.info("✅ Backfill of connection %s: %s readings imported", conn_id, written)
+    except Exception as e:
+        BACKFILLS.labels("error").inc()
+        logger.error("❌ Backfill of connection %s failed: %s", conn_id, e)
+    finally:
+        with _lock:
+            _in_flight.discard(conn_id)
+
+
+def start_backfill(conn_id, user_id, vendor, client=None):
+    """
+    Runs `backfill` in the background, once at a time per connection.
+    :return: False if a backfill of this connection is already running
+    """
+    global _executor
+    if vendor not in HISTORY:
+        return False
+    with _lock:
+        if conn_id in _in_flight:
+            return False
+        _in_flight.add(conn_id)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=BACKFILL_WORKERS, thread_name_prefix="cgm-backfill")
+    _executor.submit(_run, conn_id, user_id, vendor, client)
+    return True
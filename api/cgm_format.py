@@ -0,0 +1,105 @@
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta, timezone
+
+JSON = "json"
+COLUMNAR = "columnar"
+BINARY = "binary"
+
+MIMETYPES = {
+    JSON: "application/json",
+    COLUMNAR: "application/vnd.opengluco.columnar+json",
+    BINARY: "application/vnd.opengluco.columnar",
+}
+
+BINARY_MAGIC = b"OGC1"
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def negotiate(args, accept):
+    """
+    Picks the response format from the `format` GET parameter, or else the Accept header.
+    :param args: request.args
+    :param accept: request.accept_mimetypes
+    :return: JSON, COLUMNAR or BINARY
+    """
+    requested = args.get("format")
+    if requested is not None:
+        if requested not in MIMETYPES:
+            raise ValueError(
+                f"Invalid format (values: {', '.join(MIMETYPES)})")
+        return requested
+
+    # Plain JSON unless the client explicitly prefers another format
+    best = accept.best_match(
+        [MIMETYPES[JSON], MIMETYPES[COLUMNAR], MIMETYPES[BINARY]], default=MIMETYPES[JSON])
+    for fmt, mimetype in MIMETYPES.items():
+        if mimetype == best:
+            return fmt
+    return JSON
+
+
+def to_seconds(dt):
+    return (dt - EPOCH) // timedelta(seconds=1)
+
+
+def to_columns(points):
+    """
+    Splits points into one series per (field, stat), each being parallel arrays
+    of delta-encoded unix timestamps (seconds) and values.
+    :param points: list of tuples (time, field, stat, value)
+    :return: list of dicts {field, stat, t0, dt, values}
+    """
+    series = {}
+    for time, field, stat, value in points:
+        series.setdefault((field, stat), []).append((to_seconds(time), value))
+
+    columns = []
+    for (field, stat), rows in series.items():
+        rows.sort(key=lambda row: row[0])
+        t0 = rows[0][0]
+        deltas = []
+        previous = t0
+        for t, _ in rows:
+            deltas.append(t - previous)
+            previous = t
+        column = {"field": field, "t0": t0, "dt": deltas,
+                  "values": [value for _, value in rows]}
+        if stat is not None:
+            column["stat"] = stat
+        columns.append(column)
+    return columns
+
+
+def encode_binary(points):
+    """
+    Packs the numeric points into a compact little-endian binary:
+    "OGC1", uint32 series count, then for each series: uint8 name length, name
+    ("field" or "field:stat"), uint32 n, int64 t0 (unix seconds), uint32[n]
+    timestamp deltas (seconds, the first one being 0) and float32[n] values.
+    :param points: list of tuples (time, field, stat, value)
+    :return: bytes
+    """
+    numeric = [point for point in points
+               if isinstance(point[3], (int, float)) and not isinstance(point[3], bool)]
+    columns = to_columns(numeric)
+
+    chunks = [BINARY_MAGIC, struct.pack("<I", len(columns))]
+    for column in columns:
+        name = column["field"]
+        if "stat" in column:
+            name += f":{column['stat']}"
+        name = name.encode()[:255]
+        deltas = array("I", column["dt"])
+        values = array("f", column["values"])
+        if sys.byteorder == "big":
+            deltas.byteswap()
+            values.byteswap()
+        chunks += [
+            struct.pack("<B", len(name)), name,
+            struct.pack("<Iq", len(deltas), column["t0"]),
+            deltas.tobytes(), values.tobytes(),
+        ]
+    return b"".join(chunks)
@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from dotenv import load_dotenv
+
+from .db_conn import get_conn
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# New secrets are encrypted with FERNET_KEY. Retired keys (comma separated) are
+# only used to read the secrets encrypted before a key change.
+FERNET_KEY = os.getenv("FERNET_KEY").encode()
+FERNET_OLD_KEYS = [key.strip().encode()
+                   for key in os.getenv("FERNET_OLD_KEYS", "").split(",") if key.strip()]
+# Secrets read with a retired key are encrypted again with FERNET_KEY
+CREDENTIALS_ROTATE = os.getenv("CREDENTIALS_ROTATE", "true").lower() == "true"
+# Encrypted columns of the "connections" table
+COLUMNS = ("password", "token")
+
+
+class CredentialStore:
+    """
+    Encrypts and decrypts the secrets of the "connections" table, and keeps
+    the decrypted ones in memory keyed by (connection id, column) along with
+    their ciphertext: a secret is decrypted again only when its row changes.
+    Secrets found encrypted with a retired key are rotated one row at a time
+    (see rotate_pending), so a key change needs no mass re-encryption.
+    Secrets are never printed, only connection ids.
+    """
+
+    def __init__(self, key=FERNET_KEY, old_keys=FERNET_OLD_KEYS, rotate=CREDENTIALS_ROTATE):
+        self._primary = Fernet(key)
+        self._fernet = MultiFernet([self._primary, *map(Fernet, old_keys)])
+        self.rotate = rotate and bool(old_keys)
+        # (conn_id, column) -> (ciphertext, plaintext)
+        self._secrets = {}
+        # (conn_id, column) -> ciphertext encrypted with a retired key
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<CredentialStore {len(self._secrets)} secrets>"
+
+    def encrypt(self, value, conn_id=None, column=None):
+        """
+        :param value: plain secret
+        :param conn_id, column: where the ciphertext is stored, to keep the plain secret in memory
+        :return: ciphertext (str), None if value is empty
+        """
+        if not value:
+            return None
+        ciphertext = self._primary.encrypt(value.encode()).decode()
+        if conn_id is not None:
+            with self._lock:
+                self._secrets[(conn_id, column)] = (ciphertext, value)
+                self._pending.pop((conn_id, column), None)
+        return ciphertext
+
+    def decrypt(self, ciphertext, conn_id=None, column=None):
+        """
+        :param ciphertext: encrypted secret, as stored
+        :param conn_id, column: where the ciphertext comes from, to reuse the plain secret
+        :return: plain secret, None if ciphertext is empty
+        :raise InvalidToken: if no key decrypts it
+        """
+        if not ciphertext:
+            return None
+        key = (conn_id, column)
+        if conn_id is not None:
+            with self._lock:
+                cached = self._secrets.get(key)
+            if cached is not None and cached[0] == ciphertext:
+                return cached[1]
+
+        try:
+            value = self._primary.decrypt(ciphertext.encode()).decode()
+            retired = False
+        except InvalidToken:
+            value = self._fernet.decrypt(ciphertext.encode()).decode()
+            retired = True
+
+        if conn_id is not None:
+            with self._lock:
+                self._secrets[key] = (ciphertext, value)
+                if retired and self.rotate:
+                    self._pending[key] = ciphertext
+        return value
+
+    def retain(self, conn_ids):
+        """
+        Forgets the secrets of the connections not in `conn_ids` (deleted, or polled elsewhere)
+        """
+        conn_ids = set(conn_ids)
+        with self._lock:
+            for key in [key for key in self._secrets if key[0] not in conn_ids]:
+                del self._secrets[key]
+                self._pending.pop(key, None)
+
+    def rotate_pending(self, limit=100):
+        """
+        Encrypts again with FERNET_KEY up to `limit` secrets read with a retired key.
+        A row changed meanwhile is left as is.
+        :return: number of secrets rotated
+        """
+        with self._lock:
+            batch = list(self._pending.items())[:limit]
+        if not batch:
+            return 0
+        rotated = 0
+        try:
+            with get_conn() as conn, conn.cursor() as cur:
+                for (conn_id, column), old in batch:
+                    if column not in COLUMNS:
+                        continue
+                    with self._lock:
+                        cached = self._secrets.get((conn_id, column))
+                    if cached is None or cached[0] != old:
+                        with self._lock:
+                            self._pending.pop((conn_id, column), None)
+                        continue
+                    new = self._fernet.rotate(old.encode()).decode()
+                    cur.execute(
+                        f"UPDATE connections SET {column} = %s WHERE id = %s AND {column} = %s",
+                        (new, conn_id, old))
+                    with self._lock:
+                        self._pending.pop((conn_id, column), None)
+                        if cur.rowcount:
+                            self._secrets[(conn_id, column)] = (new, cached[1])
+                    rotated += cur.rowcount
+        except Exception as e:
+            logger.error("❌ Can't rotate secrets: %s", e)
+        if rotated:
+            logger.info("♻️ %s secrets encrypted again with the current FERNET_KEY", rotated)
+        return rotated
+
+
+credentials = CredentialStore()
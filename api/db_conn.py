@@ -1,20 +1,41 @@
+import atexit
+import logging
 import os
+import threading
 import time
+from contextlib import contextmanager
 
 import psycopg
 from dotenv import load_dotenv
+from psycopg_pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+POSTGRES_POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", "1"))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", "10"))
+POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", "10"))
+
+INIT_DB_LOCK_ID = 4241
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def conninfo():
+    return f"dbname={os.getenv('POSTGRES_DB')} user={os.getenv('POSTGRES_USER')} password={os.getenv('POSTGRES_PASSWORD')} host={os.getenv('POSTGRES_HOST')}"
+
 
 def init_db():
     for attempt in range(10):  # 10 tentatives max
         try:
-            conn = psycopg.connect(
-                f"dbname={os.getenv('POSTGRES_DB')} user={os.getenv('POSTGRES_USER')} password={os.getenv('POSTGRES_PASSWORD')} host={os.getenv('POSTGRES_HOST')}"
-            )
+            conn = psycopg.connect(conninfo())
             with conn:
                 with conn.cursor() as cur:
+                    # Web workers and pollers may start at the same time
+                    cur.execute("SELECT pg_advisory_xact_lock(%s)",
+                                (INIT_DB_LOCK_ID,))
                     cur.execute("""
                         CREATE TABLE IF NOT EXISTS "users" (
                           "id" INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
@@ -47,12 +68,34 @@ def init_db():
                         );
                         ALTER TABLE "connections" ADD FOREIGN KEY ("user_id") REFERENCES "users" ("id");
                         ALTER TABLE "remember_tokens" ADD FOREIGN KEY ("user_id") REFERENCES "users" ("id");
+
+                        -- Lets the poller only reload the connections that changed
+                        ALTER TABLE "connections" ADD COLUMN IF NOT EXISTS "updated_at" timestamptz NOT NULL DEFAULT (now());
+                        CREATE INDEX IF NOT EXISTS "connections_updated_at_idx" ON "connections" ("updated_at");
+                        CREATE OR REPLACE FUNCTION "connections_touch"() RETURNS trigger AS $$
+                        BEGIN
+                          -- Saving a vendor session (token, account_id) isn't a change of the connection
+                          IF (NEW.user_id, NEW.username, NEW.password, NEW.type, NEW.region)
+                             IS DISTINCT FROM (OLD.user_id, OLD.username, OLD.password, OLD.type, OLD.region) THEN
+                            NEW.updated_at = now();
+                          END IF;
+                          RETURN NEW;
+                        END;
+                        $$ LANGUAGE plpgsql;
+                        CREATE OR REPLACE TRIGGER "connections_touch" BEFORE UPDATE ON "connections"
+                          FOR EACH ROW EXECUTE FUNCTION "connections_touch"();
+
+                        -- Alive poller nodes, sharing the connections to poll
+                        CREATE TABLE IF NOT EXISTS "poller_nodes" (
+                          "node_id" varchar PRIMARY KEY,
+                          "heartbeat_at" timestamptz NOT NULL DEFAULT (now())
+                        );
                     """)
-            print("✅ Successfully connected to PostgreSQL DB.")
+            logger.info("✅ Successfully connected to PostgreSQL DB.")
             return conn
         except psycopg.OperationalError as e:
-            print(
-                f"⏳ Connection to PostgreSQL: attempt {attempt + 1}/10 : Not ready ({e})")
+            logger.warning(
+                "⏳ Connection to PostgreSQL: attempt %s/10 : Not ready (%s)", attempt + 1, e)
             time.sleep(2)
 
     raise Exception(
@@ -60,7 +103,76 @@ def init_db():
     )
 
 
+@contextmanager
+def init_lock(lock_id=INIT_DB_LOCK_ID):
+    """
+    Holds the lock of init_db (or `lock_id`) on a dedicated connection for the
+    duration of the block, so that only one process at a time provisions the other services.
+    """
+    with psycopg.connect(conninfo(), autocommit=True) as conn:
+        conn.execute("SELECT pg_advisory_lock(%s)", (lock_id,))
+        try:
+            yield
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
+
+
+def get_pool():
+    """
+    Returns the connection pool of the current process, created on first use
+    (i.e. after gunicorn has forked its workers).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                conninfo(),
+                min_size=POSTGRES_POOL_MIN_SIZE,
+                max_size=POSTGRES_POOL_MAX_SIZE,
+                timeout=POSTGRES_POOL_TIMEOUT,
+                # Checked before being lent, so a restarted PostgreSQL doesn't break requests
+                check=ConnectionPool.check_connection,
+                name="opengluco",
+            )
+            atexit.register(_pool.close)
+        return _pool
+
+
 def get_conn():
-    return psycopg.connect(
-        f"dbname={os.getenv('POSTGRES_DB')} user={os.getenv('POSTGRES_USER')} password={os.getenv('POSTGRES_PASSWORD')} host={os.getenv('POSTGRES_HOST')}"
-    )
+    """
+    Borrows a connection from the pool, to be used as a context manager:
+    the transaction is committed when the block exits (rolled back on exception)
+    and the connection is given back to the pool.
+
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(...)
+    """
+    return get_pool().connection()
+
+
+def listen(channel, on_notify, on_connect=None, on_disconnect=None):
+    """
+    Blocking LISTEN loop on a dedicated connection, reconnecting with a backoff.
+    Notifications sent while disconnected are lost: `on_connect` is called once
+    listening again so that callers can drop what they may have missed.
+    :param channel: channel name
+    :param on_notify: function(payload)
+    :param on_connect: function(), optional
+    :param on_disconnect: function(), optional
+    """
+    backoff = 1
+    while True:
+        try:
+            with psycopg.connect(conninfo(), autocommit=True) as conn:
+                conn.execute(f"LISTEN {channel}")
+                if on_connect is not None:
+                    on_connect()
+                backoff = 1
+                for notify in conn.notifies():
+                    on_notify(notify.payload)
+        except Exception as e:
+            logger.error("❌ Listener %s: %s, retrying in %ss", channel, e, backoff)
+        if on_disconnect is not None:
+            on_disconnect()
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 60)
@@ -1,9 +1,25 @@
+import atexit
+import logging
 import os
-from datetime import datetime
+import re
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from time import monotonic, perf_counter
 
 from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.bucket_api import BucketsApi
 from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.domain.task_create_request import TaskCreateRequest
+from influxdb_client.domain.task_update_request import TaskUpdateRequest
+from influxdb_client.rest import ApiException
+
+from .db_conn import init_lock
+from .metrics import (INFLUX_ERRORS, INFLUX_POINTS_DROPPED,
+                      INFLUX_POINTS_WRITTEN, INFLUX_QUERY_SECONDS,
+                      INFLUX_QUEUE_DEPTH, INFLUX_WRITE_SECONDS)
+
+logger = logging.getLogger(__name__)
 
 INFLUX_URL = os.getenv("INFLUXDB_HOST", "http://localhost:8086")
 INFLUX_TOKEN = os.getenv("DOCKER_INFLUXDB_INIT_ADMIN_TOKEN")
@@ -11,80 +27,669 @@ INFLUX_ORG = os.getenv("DOCKER_INFLUXDB_INIT_ORG")
 INFLUX_BUCKET = os.getenv("DOCKER_INFLUXDB_INIT_BUCKET")
 INFLUX_RETENTION = os.getenv("DOCKER_INFLUXDB_RETENTION", "30d")
 
+# Downsampled copies of the raw bucket, filled by InfluxDB tasks (see
+# init_influx_bucket): (window, retention), each one computed from the previous one
+INFLUX_ROLLUPS = os.getenv("INFLUX_ROLLUPS", "true").lower() == "true"
+ROLLUPS = [
+    ("5m", os.getenv("INFLUX_ROLLUP_5M_RETENTION", "180d")),
+    ("1h", os.getenv("INFLUX_ROLLUP_1H_RETENTION", "730d")),
+    ("1d", os.getenv("INFLUX_ROLLUP_1D_RETENTION", "3650d")),
+]
+# Seconds before checking again whether a rollup holds the oldest raw points
+ROLLUP_COVERAGE_TTL = 60
+# Seeding the rollups from the raw history (pollers only, see seed_rollups)
+ROLLUP_SEED_LOCK_ID = 4242
+
+# Window recomputed by each run of a rollup task (at least two of its windows), so that
+# readings polled late are included. Backfilled history is recomputed by recompute_rollups.
+INFLUX_ROLLUP_LOOKBACK = os.getenv("INFLUX_ROLLUP_LOOKBACK", "30m")
+
+INFLUX_BATCH_SIZE = int(os.getenv("INFLUX_BATCH_SIZE", "1000"))
+INFLUX_FLUSH_INTERVAL = float(os.getenv("INFLUX_FLUSH_INTERVAL", "5"))
+INFLUX_QUEUE_SIZE = int(os.getenv("INFLUX_QUEUE_SIZE", "100000"))
+INFLUX_MAX_BACKOFF = float(os.getenv("INFLUX_MAX_BACKOFF", "60"))
+
+# "dropped=N" at the end of the error message of a partial write
+PARTIAL_WRITE_DROPPED = re.compile(r"dropped=(\d+)")
+
+_client = None
+_writer = None
+_lock = threading.RLock()
+# Rollup tasks created or found by init_influx_bucket in this process
+_rollup_tasks = False
+# every -> (monotonic time of the check, True if the rollup holds the oldest raw points)
+_rollup_coverage = {}
+
+
+def get_influx_client():
+    """
+    Returns the InfluxDB client shared by the whole process
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = InfluxDBClient(
+                url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
+        return _client
+
+
+class InfluxWriter:
+    """
+    Long-lived InfluxDB writer.
+    Points are buffered in a bounded in-memory queue and flushed as line-protocol
+    batches by a background thread, once `batch_size` points are waiting or every
+    `flush_interval` seconds. Failed flushes are retried with exponential backoff
+    while new points keep piling up in the queue; when the queue is full the
+    oldest points are dropped.
+    """
+
+    def __init__(self, batch_size=INFLUX_BATCH_SIZE, flush_interval=INFLUX_FLUSH_INTERVAL,
+                 queue_size=INFLUX_QUEUE_SIZE, max_backoff=INFLUX_MAX_BACKOFF):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+
+        self._queue = deque(maxlen=queue_size)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._flush_requested = False
+        self._writing = False
+        self._stop_event = threading.Event()
+        self.dropped = 0
+        # Points queued, and points written or dropped, since the start
+        self._queued = 0
+        self._done = 0
+        # (value of _queued when registered, callback), see call_when_written
+        self._callbacks = []
+
+        self._write_api = get_influx_client().write_api(write_options=SYNCHRONOUS)
+        self._thread = threading.Thread(
+            target=self._run, name="influx-writer", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, line):
+        """
+        Adds a line-protocol record to the queue, never blocks
+        """
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+                self._done += 1
+                INFLUX_POINTS_DROPPED.inc()
+                if self.dropped % 1000 == 1:
+                    logger.error(
+                        "❌ InfluxDB write queue full, %s points dropped so far", self.dropped)
+            self._queue.append(line)
+            self._queued += 1
+            INFLUX_QUEUE_DEPTH.set(len(self._queue))
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Asks the background thread to flush the queue now.
+        :param timeout: seconds to wait for the queue to be written, None not to wait
+        :return: True if the queue was written
+        """
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            if timeout is None:
+                return False
+            return self._cond.wait_for(lambda: not (self._queue or self._writing), timeout)
+
+    def call_when_written(self, callback):
+        """
+        Calls `callback` from the background thread once the points queued so
+        far are written (or dropped), and asks for a flush. Doesn't wait.
+        """
+        with self._cond:
+            if self._done < self._queued:
+                self._callbacks.append((self._queued, callback))
+                self._flush_requested = True
+                self._cond.notify_all()
+                return
+        callback()
+
+    def _ready_callbacks(self):
+        # Called with self._cond held
+        ready = [callback for queued, callback in self._callbacks if queued <= self._done]
+        self._callbacks = [(queued, callback) for queued, callback in self._callbacks
+                           if queued > self._done]
+        return ready
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def _next_batch(self):
+        with self._cond:
+            if len(self._queue) < self.batch_size and not (self._stopped or self._flush_requested):
+                self._cond.wait(self.flush_interval)
+            size = min(self.batch_size, len(self._queue))
+            # A requested flush goes on until the queue is empty
+            self._flush_requested = self._flush_requested and len(self._queue) > size
+            self._writing = size > 0
+            batch = [self._queue.popleft() for _ in range(size)]
+            INFLUX_QUEUE_DEPTH.set(len(self._queue))
+            return batch
+
+    def _write(self, batch):
+        backoff = 1
+        while True:
+            try:
+                with INFLUX_WRITE_SECONDS.time():
+                    self._write_api.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG,
+                                          record=batch, write_precision=WritePrecision.NS)
+                INFLUX_POINTS_WRITTEN.inc(len(batch))
+                return
+            except ApiException as e:
+                INFLUX_ERRORS.labels("write").inc()
+                # Rejected data won't be accepted on retry
+                if e.status is not None and 400 <= e.status < 500 and e.status != 429:
+                    # Partial write (ex: field type conflict): the other points are stored
+                    partial = PARTIAL_WRITE_DROPPED.search(e.body or "")
+                    dropped = min(int(partial.group(1)), len(batch)) if partial else len(batch)
+                    INFLUX_POINTS_DROPPED.inc(dropped)
+                    INFLUX_POINTS_WRITTEN.inc(len(batch) - dropped)
+                    logger.error("❌ Erreur InfluxDB : %s/%s points rejected (%s): %s",
+                                 dropped, len(batch), e.status, (e.body or e.reason or "")[:1000])
+                    return
+                logger.warning("❌ Erreur InfluxDB : %s, retrying in %ss", e, backoff)
+            except Exception as e:
+                INFLUX_ERRORS.labels("write").inc()
+                logger.warning("❌ Erreur InfluxDB : %s, retrying in %ss", e, backoff)
+            if self._stopped:
+                return
+            self._stop_event.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+                with self._cond:
+                    self._writing = False
+                    self._done += len(batch)
+                    ready = self._ready_callbacks()
+                    self._cond.notify_all()
+                for callback in ready:
+                    try:
+                        callback()
+                    except Exception as e:
+                        logger.error("❌ Erreur après écriture InfluxDB : %s", e)
+            elif self._stopped:
+                return
+
+    def close(self):
+        """
+        Flushes the remaining points and stops the writer
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._stop_event.set()
+        self._thread.join(timeout=self.flush_interval + 10)
+
+
+def get_writer():
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = InfluxWriter()
+            atexit.register(_writer.close)
+        return _writer
+
+
+def flush_influx(timeout=None):
+    """
+    Flushes the points buffered so far (ex: at the end of a polling cycle)
+    :param timeout: seconds to wait for them to be written, None not to wait
+    :return: True if they were written
+    """
+    if _writer is not None:
+        return _writer.flush(timeout)
+    return True
+
+
+def after_flush(callback):
+    """
+    Calls `callback` once the points buffered so far are written (ex: to notify
+    the API workers), from the writer thread: the caller doesn't wait.
+    """
+    get_writer().call_when_written(callback)
+
+
+def to_line_protocol(measurement, tags, fields, timestamp=None):
+    """
+    :param timestamp: datetime (optionnel), sinon maintenant
+    :return: point au format line protocol
+    """
+    if not timestamp:
+        timestamp = datetime.now()
+
+    point = Point(measurement)
+
+    for k, v in tags.items():
+        point = point.tag(k, v)
+    for k, v in fields.items():
+        point = point.field(k, v)
+
+    point = point.time(timestamp, WritePrecision.NS)
+    return point.to_line_protocol()
+
 
 def write_to_influx(measurement, tags, fields, timestamp=None):
     """
-    Écrit un point dans InfluxDB
+    Ajoute un point à la file d'écriture InfluxDB (non bloquant)
     :param measurement: nom de la mesure (ex: "glucose")
     :param tags: dict des tags (ex: {"user_id": "123"})
     :param fields: dict des champs (ex: {"value": 5.6})
     :param timestamp: datetime (optionnel), sinon maintenant
     """
     try:
-        with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client:
-            write_api = client.write_api(write_options=SYNCHRONOUS)
+        get_writer().enqueue(to_line_protocol(
+            measurement, tags, fields, timestamp))
+    except Exception as e:
+        INFLUX_ERRORS.labels("write").inc()
+        logger.error("❌ Erreur InfluxDB : %s", e)
 
-            if not timestamp:
-                timestamp = datetime.now()
 
-            point = Point(measurement)
+def write_batch_to_influx(measurement, tags, points):
+    """
+    Écrit plusieurs points en une seule requête synchrone, sans passer par la
+    file d'écriture (ex: import d'historique). Les erreurs sont levées.
+    :param measurement: nom de la mesure (ex: "glucose")
+    :param tags: dict des tags communs à tous les points
+    :param points: liste de tuples (fields, timestamp)
+    """
+    if not points:
+        return
+    try:
+        with INFLUX_WRITE_SECONDS.time():
+            get_influx_client().write_api(write_options=SYNCHRONOUS).write(
+                bucket=INFLUX_BUCKET, org=INFLUX_ORG,
+                record=[to_line_protocol(measurement, tags, fields, timestamp)
+                        for fields, timestamp in points],
+                write_precision=WritePrecision.NS)
+    except Exception:
+        INFLUX_ERRORS.labels("write").inc()
+        raise
+    INFLUX_POINTS_WRITTEN.inc(len(points))
 
-            for k, v in tags.items():
-                point = point.tag(k, v)
-            for k, v in fields.items():
-                point = point.field(k, v)
 
-            point = point.time(timestamp, WritePrecision.NS)
+def query_records(name, flux_query, client=None):
+    """
+    Streams the records of a Flux query, timed until the last one under the
+    label `name` of opengluco_influx_query_seconds. Errors are raised.
+    :param client: InfluxDBClient, the shared one by default
+    """
+    began = perf_counter()
+    try:
+        yield from (client or get_influx_client()).query_api().query_stream(flux_query)
+    except Exception:
+        INFLUX_ERRORS.labels("query").inc()
+        raise
+    finally:
+        INFLUX_QUERY_SECONDS.labels(name).observe(perf_counter() - began)
+
+
+AGGREGATES = ("mean", "min", "max")
+PERCENTILES = (10, 25, 75, 90)
+
+RESOLUTION_FORMAT = re.compile(r"^[1-9][0-9]*(s|m|h|d|w)$")
+FIELD_FORMAT = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
 
-            write_api.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG,
-                            record=point, write_precision=WritePrecision.NS)
-            # print(f"✅ Données envoyées dans InfluxDB : {measurement} {fields}")
+# Field of a rollup bucket aggregated by each aggregate, "value" being the mean
+ROLLUP_FIELDS = {"min": "value_min", "max": "value_max"}
+
+
+def rollup_bucket(every):
+    return f"{INFLUX_BUCKET}_{every}"
+
+
+def pick_rollup(resolution, fields=None):
+    """
+    Returns the coarsest rollup whose windows fit exactly in `resolution` windows.
+    :param resolution: durée Flux des fenêtres d'agrégation (ex: "1h"), None pour les points bruts
+    :param fields: champs demandés, les rollups n'ont que "value"
+    :return: fenêtre du rollup (ex: "1h"), None pour le bucket brut
+    """
+    if not INFLUX_ROLLUPS or not _rollup_tasks or resolution is None or (fields and fields != ["value"]):
+        return None
+    seconds = parse_retention(resolution)
+    for every, _ in reversed(ROLLUPS):
+        if seconds % parse_retention(every) == 0:
+            # Not seeded yet: the raw bucket still has points the rollup hasn't
+            return every if rollup_covered(every) else None
+    return None
+
+
+def first_time(bucket, client=None):
+    """
+    :return: time of the oldest glucose point of a bucket (datetime), None if it's empty
+    """
+    flux_query = "\n".join([
+        f'from(bucket: "{bucket}")',
+        '  |> range(start: 0)',
+        '  |> filter(fn: (r) => r["_measurement"] == "glucose")',
+        '  |> filter(fn: (r) => r["_field"] == "value")',
+        '  |> first()',
+        '  |> keep(columns: ["_time"])',
+    ])
+    return min((record.get_time() for record in query_records("first_time", flux_query, client)),
+               default=None)
+
+
+def rollup_covered(every, client=None):
+    """
+    Tells whether a rollup holds the oldest raw points, i.e. whether it was
+    seeded from the raw history (see seed_rollups). Checked at most every
+    ROLLUP_COVERAGE_TTL seconds, and no more once it is.
+    """
+    checked = _rollup_coverage.get(every)
+    if checked is not None and (checked[1] or monotonic() - checked[0] < ROLLUP_COVERAGE_TTL):
+        return checked[1]
+    try:
+        raw_first = first_time(INFLUX_BUCKET, client)
+        covered = True
+        if raw_first is not None:
+            # Rollup points are stamped at the start of their window
+            rollup_first = first_time(rollup_bucket(every), client)
+            covered = rollup_first is not None and rollup_first <= raw_first
     except Exception as e:
-        print(f"❌ Erreur InfluxDB : {e}")
+        logger.error("❌ Erreur lecture InfluxDB : %s", e)
+        covered = False
+    _rollup_coverage[every] = (monotonic(), covered)
+    return covered
 
 
-def read_from_influx(user_id, measurement="glucose", range_hours=24):
+def aggregation_flux(resolution, rollup=False):
     """
-    Lit les données InfluxDB pour un user_id donné.
+    Builds the Flux statements aggregating the `data` stream into `resolution`
+    windows: one yielded result per aggregate (mean, min, max) and percentile (p10...).
+    Read from a rollup bucket, min and max come from its "value_min" and "value_max"
+    fields and percentiles are computed over its means.
+    """
+    def source(fn):
+        if not rollup:
+            return "data"
+        field = ROLLUP_FIELDS.get(fn, "value")
+        return f'''data |> filter(fn: (r) => r["_field"] == "{field}") |> set(key: "_field", value: "value")'''
+
+    statements = [
+        f'''{source(fn)} |> aggregateWindow(every: {resolution}, fn: {fn}, createEmpty: false) |> yield(name: "{fn}")'''
+        for fn in AGGREGATES
+    ]
+    statements += [
+        f'''{source("mean")} |> aggregateWindow(every: {resolution}, fn: (column, tables=<-) => tables |> quantile(q: {p / 100}, column: column), createEmpty: false) |> yield(name: "p{p}")'''
+        for p in PERCENTILES
+    ]
+    return "\n".join(statements)
+
+
+def flux_time(value):
+    """
+    Formats a range bound for Flux: datetimes become RFC3339 UTC literals,
+    strings are kept as they are (relative durations, ex: "-24h")
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+    return value
+
+
+def build_flux_query(user_id, measurement="glucose", start="-24h", stop=None, fields=None, resolution=None, after=None):
+    """
+    Builds the single Flux query answering a CGM data request.
     :param user_id: ID utilisateur à filtrer (tag)
     :param measurement: nom de la mesure (ex: "glucose")
-    :param range_hours: fenêtre temporelle à lire (ex: 24h)
-    :return: liste de points {time, fields...}
+    :param start: début de la fenêtre (datetime ou durée relative, ex: "-24h")
+    :param stop: fin de la fenêtre (datetime ou durée relative), None pour maintenant
+    :param fields: liste des champs à lire, None pour tous (seulement "value" si agrégés)
+    :param resolution: durée Flux des fenêtres d'agrégation (ex: "1h"), None pour les points bruts
+    :param after: ne garder que les points strictement postérieurs (datetime), optionnel
+    :return: requête Flux
     """
-    try:
-        with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client:
-            query_api = client.query_api()
+    if resolution is not None and not RESOLUTION_FORMAT.match(resolution):
+        raise ValueError(f"Invalid resolution: {resolution}")
+    if resolution is not None and not fields:
+        fields = ["value"]
+    for field in fields or []:
+        if not FIELD_FORMAT.match(field):
+            raise ValueError(f"Invalid field: {field}")
 
-            flux_query = f'''
-                from(bucket: "{INFLUX_BUCKET}")
-                  |> range(start: -{range_hours}h)
-                  |> filter(fn: (r) => r["_measurement"] == "{measurement}")
-                  |> filter(fn: (r) => r["user_id"] == "{user_id}")
-            '''
+    # Aggregated views are read from the coarsest rollup that can answer them
+    rollup = pick_rollup(resolution, fields)
+    bucket = INFLUX_BUCKET
+    if rollup is not None:
+        bucket = rollup_bucket(rollup)
+        fields = ["value", *ROLLUP_FIELDS.values()]
 
-            tables = query_api.query(flux_query)
+    bounds = f"start: {flux_time(start)}"
+    if stop is not None:
+        bounds += f", stop: {flux_time(stop)}"
 
-            results = []
-            for table in tables:
-                for record in table.records:
-                    results.append({
-                        "time": record.get_time().isoformat(),
-                        "field": record.get_field(),
-                        "value": record.get_value()
-                    })
+    lines = [
+        f'from(bucket: "{bucket}")',
+        f'  |> range({bounds})',
+        f'  |> filter(fn: (r) => r["_measurement"] == "{measurement}")',
+        f'  |> filter(fn: (r) => r["user_id"] == "{user_id}")',
+    ]
+    if fields:
+        condition = " or ".join(f'r["_field"] == "{field}"' for field in fields)
+        lines.append(f'  |> filter(fn: (r) => {condition})')
+    if after is not None:
+        # range() start is inclusive
+        lines.append(f'  |> filter(fn: (r) => r["_time"] > {flux_time(after)})')
+    if resolution is not None:
+        # Aggregated by InfluxDB, all devices of the user together
+        lines[0] = f"data = {lines[0]}"
+        lines.append('  |> group(columns: ["_measurement", "_field"])')
+        lines.append(aggregation_flux(resolution, rollup is not None))
+    flux_query = "\n".join(lines)
+    return flux_query
 
-            return results
+
+def iter_points(user_id, measurement="glucose", range_hours=24, resolution=None, start=None, stop=None, fields=None, after=None):
+    """
+    Lit les données InfluxDB pour un user_id donné, en une seule requête,
+    au fil de leur réception (la réponse n'est jamais entièrement en mémoire).
+    Les erreurs sont levées.
+    :param user_id: ID utilisateur à filtrer (tag)
+    :param measurement: nom de la mesure (ex: "glucose")
+    :param range_hours: fenêtre temporelle à lire (ex: 24h), ignorée si start est donné
+    :param resolution: durée Flux des fenêtres d'agrégation (ex: "1h"), None pour les points bruts
+    :param start: début de la fenêtre (datetime), optionnel
+    :param stop: fin de la fenêtre (datetime), optionnel
+    :param fields: liste des champs à lire, optionnel
+    :param after: ne garder que les points strictement postérieurs (datetime), optionnel
+    :return: générateur de tuples (time, field, stat, value), stat valant None pour les points bruts
+    """
+    flux_query = build_flux_query(
+        user_id, measurement,
+        start=start if start is not None else f"-{range_hours}h",
+        stop=stop, fields=fields, resolution=resolution, after=after)
+
+    for record in query_records("points", flux_query):
+        yield record_to_point(record, resolution is not None)
+
+
+def record_to_point(record, aggregated):
+    return (
+        record.get_time(),
+        record.get_field(),
+        record.values.get("result") if aggregated else None,
+        record.get_value()
+    )
+
+
+def read_points_and_last_time(user_id, measurement="glucose", resolution=None, start=None, stop=None, fields=None, after=None):
+    """
+    Comme iter_points, avec le temps du dernier point de l'utilisateur depuis
+    `start` (voir read_last_time), en une seule requête InfluxDB.
+    Les erreurs sont levées.
+    :return: (liste de tuples (time, field, stat, value), datetime ou None)
+    """
+    if resolution is None:
+        points = list(iter_points(user_id, measurement, resolution=None,
+                                  start=start, stop=stop, fields=fields, after=after))
+        return points, max((point[0] for point in points), default=None)
+
+    flux_query = "\n".join([
+        build_flux_query(user_id, measurement, start=start, stop=stop,
+                         fields=fields, resolution=resolution, after=after),
+        last_time_flux(user_id, measurement, start),
+        '  |> yield(name: "last")',
+    ])
+    points, last_time = [], None
+    for record in query_records("points", flux_query):
+        if record.values.get("result") == "last":
+            if last_time is None or record.get_time() > last_time:
+                last_time = record.get_time()
+        else:
+            points.append(record_to_point(record, True))
+    return points, last_time
+
+
+def read_points(user_id, measurement="glucose", range_hours=24, resolution=None, start=None, stop=None, fields=None, after=None):
+    """
+    Comme iter_points, mais renvoie une liste (vide en cas d'erreur).
+    :return: liste de tuples (time, field, stat, value)
+    """
+    try:
+        return list(iter_points(user_id, measurement, range_hours, resolution, start, stop, fields, after))
 
     except Exception as e:
-        print(f"❌ Erreur lecture InfluxDB : {e}")
+        logger.error("❌ Erreur lecture InfluxDB : %s", e)
         return []
 
 
+def point_to_dict(point):
+    """
+    :param point: tuple (time, field, stat, value)
+    :return: dict {time, field, value} ({time, field, stat, value} si agrégé)
+    """
+    time, field, stat, value = point
+    result = {"time": time.isoformat(), "field": field, "value": value}
+    if stat is not None:
+        result["stat"] = stat
+    return result
+
+
+def read_from_influx(user_id, measurement="glucose", range_hours=24, resolution=None, start=None, stop=None, fields=None, after=None):
+    """
+    Comme read_points, mais renvoie des dicts.
+    :return: liste de points {time, field, value} ({time, field, stat, value} si agrégés)
+    """
+    return [point_to_dict(point) for point in read_points(
+        user_id, measurement, range_hours, resolution, start, stop, fields, after)]
+
+
+def read_last_time(user_id, measurement="glucose", start="-24h"):
+    """
+    Returns the time of the latest point of a user (None if none): a cheap
+    last() query used to know whether anything changed.
+    :param user_id: ID utilisateur à filtrer (tag)
+    :param measurement: nom de la mesure (ex: "glucose")
+    :param start: début de la fenêtre de recherche (datetime ou durée relative)
+    :return: datetime ou None
+    """
+    flux_query = last_time_flux(user_id, measurement, start)
+
+    try:
+        return max((record.get_time() for record in query_records("last_time", flux_query)), default=None)
+
+    except Exception as e:
+        logger.error("❌ Erreur lecture InfluxDB : %s", e)
+        return None
+
+
+def last_time_flux(user_id, measurement, start):
+    return "\n".join([
+        build_flux_query(user_id, measurement, start=start, fields=["value"]),
+        "  |> last()",
+    ])
+
+
+def read_last_times(start, measurement="glucose"):
+    """
+    Returns the time of the latest point of every device of every user, in one query.
+    Errors are raised.
+    :param start: début de la fenêtre de recherche (datetime ou durée relative)
+    :param measurement: nom de la mesure (ex: "glucose")
+    :return: dict {(user_id, device): datetime}
+    """
+    flux_query = "\n".join([
+        f'from(bucket: "{INFLUX_BUCKET}")',
+        f'  |> range(start: {flux_time(start)})',
+        f'  |> filter(fn: (r) => r["_measurement"] == "{measurement}")',
+        '  |> filter(fn: (r) => r["_field"] == "value")',
+        '  |> last()',
+        '  |> keep(columns: ["_time", "user_id", "device"])',
+    ])
+    return {(record.values.get("user_id"), record.values.get("device")): record.get_time()
+            for record in query_records("last_times", flux_query)}
+
+
+def iter_series(user_id, every, start, stop=None, measurement="glucose"):
+    """
+    Lit la glycémie moyenne d'un utilisateur par fenêtre de `every`, tous
+    appareils confondus, depuis le rollup le plus grossier possible. Les erreurs sont levées.
+    :param user_id: ID utilisateur à filtrer (tag)
+    :param every: durée Flux des fenêtres (ex: "5m")
+    :param start: début de la fenêtre (datetime ou durée relative)
+    :param stop: fin de la fenêtre (datetime ou durée relative), None pour maintenant
+    :param measurement: nom de la mesure (ex: "glucose")
+    :return: générateur de tuples (time, value)
+    """
+    if not RESOLUTION_FORMAT.match(every):
+        raise ValueError(f"Invalid resolution: {every}")
+    rollup = pick_rollup(every)
+    bounds = f"start: {flux_time(start)}"
+    if stop is not None:
+        bounds += f", stop: {flux_time(stop)}"
+
+    flux_query = "\n".join([
+        f'from(bucket: "{rollup_bucket(rollup) if rollup else INFLUX_BUCKET}")',
+        f'  |> range({bounds})',
+        f'  |> filter(fn: (r) => r["_measurement"] == "{measurement}")',
+        f'  |> filter(fn: (r) => r["user_id"] == "{user_id}")',
+        '  |> filter(fn: (r) => r["_field"] == "value")',
+        '  |> group()',
+        f'  |> aggregateWindow(every: {every}, fn: mean, createEmpty: false)',
+        '  |> keep(columns: ["_time", "_value"])',
+    ])
+    for record in query_records("series", flux_query):
+        yield record.get_time(), record.get_value()
+
+
+def read_times(user_id, device, start, measurement="glucose"):
+    """
+    Returns the times of the points already stored for a device of a user. Errors are raised.
+    :param user_id: ID utilisateur à filtrer (tag)
+    :param device: device à filtrer (tag, ex: "Dexcom")
+    :param start: début de la fenêtre (datetime ou durée relative)
+    :param measurement: nom de la mesure (ex: "glucose")
+    :return: set de datetimes
+    """
+    flux_query = "\n".join([
+        build_flux_query(user_id, measurement, start=start, fields=["value"]),
+        f'  |> filter(fn: (r) => r["device"] == "{device}")',
+        '  |> keep(columns: ["_time"])',
+    ])
+    return {record.get_time() for record in query_records("times", flux_query)}
+
+
 def parse_retention(ret_str: str) -> int:
     unit = ret_str[-1]
     value = int(ret_str[:-1])
     if unit == "d":
         return value * 24 * 3600
+    elif unit == "w":
+        return value * 7 * 24 * 3600
     elif unit == "h":
         return value * 3600
     elif unit == "m":
@@ -92,35 +697,185 @@ def parse_retention(ret_str: str) -> int:
     elif unit == "s":
         return value
     else:
-        raise ValueError("Format de durée non supporté (utilise d/h/m/s)")
+        raise ValueError("Format de durée non supporté (utilise w/d/h/m/s)")
+
 
+def rollup_flux(every, source_bucket, from_rollup, start, stop=None, user_id=None):
+    """
+    Builds the Flux statements computing the `every` rollup from `source_bucket`.
+    :param from_rollup: True if the source is itself a rollup bucket
+    :param start: début de la fenêtre recalculée, aligné sur `every` (expression Flux)
+    :param stop: fin de la fenêtre (expression Flux), None pour maintenant
+    :param user_id: ne recalculer que cet utilisateur, None pour tous
+    :return: Flux statements
+    """
+    # (source field, aggregate, rollup field)
+    aggregates = [("value", "mean", "value")]
+    aggregates += [(field if from_rollup else "value", fn, field)
+                   for fn, field in ROLLUP_FIELDS.items()]
+
+    bounds = f"start: {start}"
+    if stop is not None:
+        bounds += f", stop: {stop}"
+    lines = [
+        f'data = from(bucket: "{source_bucket}")',
+        f'  |> range({bounds})',
+        '  |> filter(fn: (r) => r["_measurement"] == "glucose")',
+    ]
+    if user_id is not None:
+        lines.append(f'  |> filter(fn: (r) => r["user_id"] == "{user_id}")')
+    for source_field, fn, field in aggregates:
+        lines += [
+            "",
+            "data",
+            f'  |> filter(fn: (r) => r["_field"] == "{source_field}")',
+            # Stamped at the window start so that the next rollup windows include it
+            f'  |> aggregateWindow(every: {every}, fn: {fn}, timeSrc: "_start", createEmpty: false)',
+            f'  |> set(key: "_field", value: "{field}")',
+            f'  |> to(bucket: "{rollup_bucket(every)}", org: "{INFLUX_ORG}")',
+            f'  |> yield(name: "{field}")',
+        ]
+    return "\n".join(lines)
 
-def init_influx_bucket():
+
+def rollup_task_flux(every, source_bucket, from_rollup, offset="1m"):
+    """
+    Builds the InfluxDB task computing the `every` rollup from `source_bucket`.
+    :param from_rollup: True if the source is itself a rollup bucket
+    :param offset: delay of each run, so that the source rollup is computed first
+    :return: Flux script of the task
+    """
+    lookback = max(parse_retention(INFLUX_ROLLUP_LOOKBACK),
+                   2 * parse_retention(every))
+    return "\n".join([
+        'import "date"',
+        "",
+        f'option task = {{name: "{rollup_bucket(every)}", every: {every}, offset: {offset}}}',
+        "",
+        # Whole windows only: a partial first window would overwrite its rollup point
+        rollup_flux(every, source_bucket, from_rollup,
+                    f"date.truncate(t: -{lookback}s, unit: {every})"),
+    ])
+
+
+def recompute_rollups(user_id, start):
+    """
+    Computes again the rollups of a user from `start` to now, once readings
+    older than the lookback of the rollup tasks were written (history backfill).
+    :param user_id: ID utilisateur
+    :param start: datetime of the oldest reading written
+    """
+    if not INFLUX_ROLLUPS:
+        return
+    # Whole windows of every rollup: they all divide the coarsest one
+    window = parse_retention(ROLLUPS[-1][0])
+    start = datetime.fromtimestamp(
+        int(start.timestamp()) // window * window, timezone.utc)
+    source_bucket = INFLUX_BUCKET
+    for every, _ in ROLLUPS:
+        flux_query = rollup_flux(every, source_bucket, source_bucket != INFLUX_BUCKET,
+                                 flux_time(start), user_id=user_id)
+        # The rollup of the next window is computed from this one
+        for _ in query_records("rollup", flux_query):
+            pass
+        source_bucket = rollup_bucket(every)
+
+
+def seed_rollups(client):
+    """
+    Computes the rollups from the whole raw history, one day at a time, unless
+    they already hold it: the tasks only compute the windows following their creation.
+    :param client: InfluxDBClient
+    """
+    if all(rollup_covered(every, client) for every, _ in ROLLUPS):
+        return
+    window = parse_retention(ROLLUPS[-1][0])
+    day = int(first_time(INFLUX_BUCKET, client).timestamp()) // window * window
+    now = datetime.now(timezone.utc).timestamp()
+    days = 0
+    while day < now:
+        start = datetime.fromtimestamp(day, timezone.utc)
+        stop = datetime.fromtimestamp(day + window, timezone.utc)
+        source_bucket = INFLUX_BUCKET
+        for every, _ in ROLLUPS:
+            flux_query = rollup_flux(every, source_bucket, source_bucket != INFLUX_BUCKET,
+                                     flux_time(start), flux_time(stop))
+            for _ in query_records("rollup", flux_query, client):
+                pass
+            source_bucket = rollup_bucket(every)
+        day += window
+        days += 1
+    _rollup_coverage.clear()
+    logger.info("✅ Rollups calculés sur %s jours d'historique", days)
+
+
+def ensure_bucket(buckets_api, name, retention):
+    retention_rules = [
+        {"type": "expire", "everySeconds": parse_retention(retention)}]
+
+    # Vérifie si le bucket existe déjà
+    bucket = buckets_api.find_bucket_by_name(name)
+    if bucket is None:
+        # Création
+        buckets_api.create_bucket(
+            bucket_name=name, org=INFLUX_ORG, retention_rules=retention_rules)
+        logger.info("✅ Bucket '%s' créé avec rétention %s", name, retention)
+    else:
+        # Mise à jour
+        bucket.retention_rules = retention_rules
+        buckets_api.update_bucket(bucket)
+        logger.info("♻️ Bucket '%s' mis à jour avec rétention %s", name, retention)
+
+
+def ensure_task(tasks_api, name, flux):
+    tasks = tasks_api.find_tasks(name=name)
+    # Left by processes provisioning at the same time before init_lock
+    for duplicate in tasks[1:]:
+        tasks_api.delete_task(duplicate.id)
+        logger.info("♻️ Tâche '%s' en double supprimée", name)
+    if not tasks:
+        tasks_api.create_task(task_create_request=TaskCreateRequest(
+            flux=flux, org=INFLUX_ORG, status="active"))
+        logger.info("✅ Tâche '%s' créée", name)
+    elif tasks[0].flux != flux:
+        tasks_api.update_task_request(
+            tasks[0].id, TaskUpdateRequest(flux=flux, status="active"))
+        logger.info("♻️ Tâche '%s' mise à jour", name)
+
+
+def init_influx_bucket(seed=False):
+    """
+    Creates or updates the buckets and the rollup tasks.
+    :param seed: also compute the rollups from the raw history written before
+        their tasks (pollers only: the API workers must start quickly, their
+        aggregated views are read from the raw bucket meanwhile)
+    """
+    global _rollup_tasks
     try:
-        with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client:
+        # Web workers and pollers may start at the same time: one of them
+        # creates the buckets and tasks, the others then find them
+        with init_lock(), InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client:
             buckets_api: BucketsApi = client.buckets_api()
+            ensure_bucket(buckets_api, INFLUX_BUCKET, INFLUX_RETENTION)
 
-            retention_seconds = parse_retention(INFLUX_RETENTION)
-
-            # Vérifie si le bucket existe déjà
-            bucket = buckets_api.find_bucket_by_name(INFLUX_BUCKET)
-            if bucket is None:
-                # Création
-                bucket = buckets_api.create_bucket(
-                    bucket_name=INFLUX_BUCKET,
-                    org=INFLUX_ORG,
-                    retention_rules=[
-                        {"type": "expire", "everySeconds": retention_seconds}]
-                )
-                print(
-                    f"✅ Bucket '{INFLUX_BUCKET}' créé avec rétention {INFLUX_RETENTION}")
-            else:
-                # Mise à jour
-                bucket.retention_rules = [
-                    {"type": "expire", "everySeconds": retention_seconds}]
-                buckets_api.update_bucket(bucket)
-                print(
-                    f"♻️ Bucket '{INFLUX_BUCKET}' mis à jour avec rétention {INFLUX_RETENTION}")
+            if INFLUX_ROLLUPS:
+                tasks_api = client.tasks_api()
+                source_bucket = INFLUX_BUCKET
+                for index, (every, retention) in enumerate(ROLLUPS):
+                    ensure_bucket(buckets_api, rollup_bucket(every), retention)
+                    ensure_task(tasks_api, rollup_bucket(every), rollup_task_flux(
+                        every, source_bucket, source_bucket != INFLUX_BUCKET, offset=f"{index + 1}m"))
+                    source_bucket = rollup_bucket(every)
+                _rollup_tasks = True
 
     except Exception as e:
-        print(f"❌ Erreur init InfluxDB bucket : {e}")
+        logger.error("❌ Erreur init InfluxDB bucket : %s", e)
+
+    if seed and _rollup_tasks:
+        try:
+            with init_lock(ROLLUP_SEED_LOCK_ID), InfluxDBClient(
+                    url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client:
+                seed_rollups(client)
+        except Exception as e:
+            # Tried again at the next start, aggregated views use the raw bucket meanwhile
+            logger.error("❌ Erreur calcul des rollups : %s", e)
@@ -1,25 +1,161 @@
+import atexit
+import copy
+import json
 import logging
+import os
+import queue
+import socket
 import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from time import monotonic
 
+from dotenv import load_dotenv
 
-def setup_logging():
-    # logging config
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.StreamHandler(sys.stdout)  # Docker logs
-        ]
-    )
+# Imported first by main.py and poller.py, before the modules loading .env
+load_dotenv()
 
-    # Redirect print to logging
-    class PrintToLogger:
-        def write(self, message):
-            if message.strip():  # ignore empty lines
-                logging.info(message.strip())
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" (one object per line, for Docker log collectors) or "text"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Records waiting to be written, the next ones are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Each message (its template, not its arguments) is logged at most
+# LOG_SAMPLE_BURST times per LOG_SAMPLE_WINDOW seconds, the next ones are counted
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", "60"))
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "10"))
 
-        def flush(self):
-            pass
+HOSTNAME = socket.gethostname()
 
-    sys.stdout = PrintToLogger()
-    sys.stderr = PrintToLogger()
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, with the service and worker that logged it
+    """
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "service": self.service,
+            # The gunicorn workers of a container only differ by their pid
+            "worker": f"{HOSTNAME}:{record.process}",
+            "thread": record.threadName,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, service):
+        super().__init__(
+            f"%(asctime)s [%(levelname)s] {service} %(process)d %(name)s: %(message)s")
+
+    def format(self, record):
+        message = super().format(record)
+        if getattr(record, "suppressed", 0):
+            message += f" ({record.suppressed} similar messages suppressed)"
+        return message
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Limits repetitive records (ex: the same vendor error for many connections):
+    the first `burst` records of a message template go through in each
+    `window`, the next ones are dropped and their count is attached to the
+    first record let through afterwards ("suppressed").
+    Critical records are never dropped.
+    """
+
+    def __init__(self, window=LOG_SAMPLE_WINDOW, burst=LOG_SAMPLE_BURST):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        # (logger, level, template) -> [window start, records in the window, suppressed]
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.CRITICAL or self.burst <= 0:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = monotonic()
+        with self._lock:
+            count = self._counts.get(key)
+            if count is None or now - count[0] >= self.window:
+                if len(self._counts) > 10000:
+                    self._counts.clear()
+                count = self._counts[key] = [now, 0, count[2] if count else 0]
+            count[1] += 1
+            if count[1] > self.burst:
+                count[2] += 1
+                return False
+            record.suppressed, count[2] = count[2], 0
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks the caller: records are dropped when the queue is full
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only the arguments are merged here, tracebacks are formatted by the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(service="api"):
+    """
+    Configures the root logger of the process: records are only queued by the
+    calling thread (the request or the polling cycle), and written to stdout by
+    a background thread.
+    :param service: name of the process in the logs (ex: "api", "poller")
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)  # Docker logs
+    stream.setFormatter(
+        TextFormatter(service) if LOG_FORMAT == "text" else JsonFormatter(service))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+
+    _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
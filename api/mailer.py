@@ -0,0 +1,154 @@
+import atexit
+import logging
+import os
+import queue
+import smtplib
+import threading
+from time import monotonic
+
+from .metrics import MAIL_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+SMTP_HOST = os.getenv("SMTP_HOST")
+SMTP_PORT = int(os.getenv("SMTP_PORT") or "465")
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASS = os.getenv("SMTP_PASS")
+# "ssl" (SMTP over TLS), "starttls", or "none" for a local debugging server
+# (ex: python -m aiosmtpd -n -l localhost:1025)
+SMTP_SECURITY = os.getenv("SMTP_SECURITY", "ssl").lower()
+
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", "1000"))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "5"))
+MAIL_MAX_BACKOFF = float(os.getenv("MAIL_MAX_BACKOFF", "60"))
+# The connection is closed after that many idle seconds, before the server does
+MAIL_IDLE_TIMEOUT = float(os.getenv("MAIL_IDLE_TIMEOUT", "30"))
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+
+_mailer = None
+_lock = threading.Lock()
+
+
+class Mailer:
+    """
+    Outbound mail queue. A background thread sends the messages over one SMTP
+    connection, kept open while messages keep coming, and retries failed
+    sends with exponential backoff. Requests only enqueue.
+    """
+
+    def __init__(self, queue_size=MAIL_QUEUE_SIZE, max_attempts=MAIL_MAX_ATTEMPTS,
+                 max_backoff=MAIL_MAX_BACKOFF, idle_timeout=MAIL_IDLE_TIMEOUT):
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._server = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="mailer", daemon=True)
+        self._thread.start()
+
+    def send(self, msg):
+        """
+        Queues a message, never blocks
+        :param msg: email.message.Message
+        :return: False if the queue is full
+        """
+        try:
+            self._queue.put_nowait(msg)
+            MAIL_QUEUE_DEPTH.set(self._queue.qsize())
+            return True
+        except queue.Full:
+            logger.error("❌ Mail queue full, message to %s dropped", msg['To'])
+            return False
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _connect(self):
+        if SMTP_SECURITY == "ssl":
+            server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_SECURITY == "starttls":
+                server.starttls()
+        if SMTP_USER:
+            server.login(SMTP_USER, SMTP_PASS)
+        return server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def _deliver(self, msg):
+        backoff = 1
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if self._server is None:
+                    self._server = self._connect()
+                self._server.send_message(msg)
+                return True
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as e:
+                # Won't be accepted on retry
+                logger.error("❌ Email to %s rejected: %s", msg['To'], e)
+                return False
+            except Exception as e:
+                self._disconnect()
+                if attempt == self.max_attempts or self._stop_event.is_set():
+                    logger.error("❌ Email to %s not sent after %s attempts: %s", msg['To'], attempt, e)
+                    return False
+                logger.warning("❌ Email to %s not sent (%s), retrying in %ss", msg['To'], e, backoff)
+            self._stop_event.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+        return False
+
+    def _run(self):
+        idle_since = monotonic()
+        while True:
+            try:
+                msg = self._queue.get(timeout=1)
+            except queue.Empty:
+                if self._stop_event.is_set():
+                    break
+                if self._server is not None and monotonic() - idle_since >= self.idle_timeout:
+                    self._disconnect()
+                continue
+            if msg is None:
+                break
+            self._deliver(msg)
+            MAIL_QUEUE_DEPTH.set(self._queue.qsize())
+            idle_since = monotonic()
+        self._disconnect()
+
+    def close(self, timeout=10):
+        """
+        Sends the queued messages (for `timeout` seconds at most) and stops the sender
+        """
+        self._stop_event.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=timeout)
+
+
+def get_mailer():
+    global _mailer
+    with _lock:
+        if _mailer is None:
+            _mailer = Mailer()
+            atexit.register(_mailer.close)
+        return _mailer
+
+
+def send_email(msg):
+    """
+    Queues an email, sent in the background
+    :param msg: email.message.Message
+    :return: False if it couldn't be queued
+    """
+    return get_mailer().send(msg)
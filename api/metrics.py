@@ -0,0 +1,95 @@
+import logging
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest,
+                               start_http_server)
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+# Set by gunicorn.conf.py: the metrics of every worker are kept in this
+# directory, and /metrics sums them up whichever worker answers
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+# Poller
+POLL_CYCLE_SECONDS = Histogram(
+    "opengluco_poll_cycle_seconds", "Duration of the polling cycles",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60))
+POLL_CALLS = Counter(
+    "opengluco_poll_calls_total", "Vendor calls of the polling cycles, by result",
+    ["result"])
+VENDOR_CALL_SECONDS = Histogram(
+    "opengluco_vendor_call_seconds", "Latency of the vendor calls (current reading)",
+    ["vendor", "region"], buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 15, 30))
+VENDOR_CALLS = Counter(
+    "opengluco_vendor_calls_total", "Vendor calls, by outcome (reading, none, error)",
+    ["vendor", "region", "outcome"])
+VENDOR_LOGINS = Counter(
+    "opengluco_vendor_logins_total", "New vendor sessions (first login or relogin)",
+    ["vendor"])
+TRACKED_CONNECTIONS = Gauge(
+    "opengluco_tracked_connections", "Connections polled by this poller",
+    ["vendor"], multiprocess_mode="livesum")
+BACKFILLS = Counter(
+    "opengluco_backfills_total", "History imports, by result", ["result"])
+
+# InfluxDB
+INFLUX_WRITE_SECONDS = Histogram(
+    "opengluco_influx_write_seconds", "Latency of the InfluxDB batch writes",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+INFLUX_POINTS_WRITTEN = Counter(
+    "opengluco_influx_points_written_total", "Points written to InfluxDB")
+INFLUX_POINTS_DROPPED = Counter(
+    "opengluco_influx_points_dropped_total", "Points dropped (queue full or rejected by InfluxDB)")
+INFLUX_QUEUE_DEPTH = Gauge(
+    "opengluco_influx_queue_depth", "Points waiting in the InfluxDB write queue",
+    multiprocess_mode="livesum")
+INFLUX_QUERY_SECONDS = Histogram(
+    "opengluco_influx_query_seconds", "Latency of the InfluxDB queries, read to the end",
+    ["query"], buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+INFLUX_ERRORS = Counter(
+    "opengluco_influx_errors_total", "InfluxDB errors, by operation", ["operation"])
+
+# API
+HTTP_REQUEST_SECONDS = Histogram(
+    "opengluco_http_request_seconds", "Latency of the API requests",
+    ["endpoint", "method", "status"])
+AUTH_CHECK_SECONDS = Histogram(
+    "opengluco_auth_check_seconds", "Duration of the token checks of the protected routes",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5))
+AUTH_FAILURES = Counter(
+    "opengluco_auth_failures_total", "Rejected tokens, by reason", ["reason"])
+PASSWORD_HASHES_REJECTED = Counter(
+    "opengluco_password_hashes_rejected_total", "Password hashes refused (queue full or timeout)")
+MAIL_QUEUE_DEPTH = Gauge(
+    "opengluco_mail_queue_depth", "Emails waiting to be sent",
+    multiprocess_mode="livesum")
+
+
+def metrics_registry():
+    """
+    :return: registry of this process, or of every gunicorn worker in multiprocess mode
+    """
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics():
+    """
+    :return: (body, content type) in the Prometheus text format
+    """
+    return generate_latest(metrics_registry()), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port):
+    """
+    Serves /metrics on its own port (processes without Flask app, ex: poller.py)
+    """
+    start_http_server(port, registry=metrics_registry())
+    logger.info("✅ Metrics served on port %s", port)
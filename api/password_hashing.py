@@ -0,0 +1,125 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+# werkzeug method, with its parameters (ex: "scrypt:65536:8:1", "pbkdf2:sha256:1000000").
+# Stored hashes of another method are upgraded on login.
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+# Hashing processes per API worker
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "1"))
+# Hashes running or waiting per API worker, beyond that requests get a 503
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "2"))
+# Seconds a request waits for its hash before giving up with a 503
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "5"))
+
+_executor = None
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE)
+
+
+class HashingOverloaded(Exception):
+    """
+    Too many password hashes pending, the request should be retried later
+    """
+    retry_after = 5
+
+
+@lru_cache(maxsize=None)
+def _full_method(method):
+    # werkzeug fills in the default parameters: "scrypt" -> "scrypt:32768:8:1"
+    return generate_password_hash("", method).split("$", 1)[0]
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method)
+
+
+def _check(stored_hash, password, method):
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    if stored_hash.split("$", 1)[0] == _full_method(method):
+        return True, None
+    return True, generate_password_hash(password, method)
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # Hashing processes are forked from a server process that only
+            # imports this module, not from the (multi-threaded) API worker
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+            _executor = ProcessPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS, mp_context=context)
+        return _executor
+
+
+def _reset_executor(executor):
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run(fn, *args):
+    """
+    Runs `fn` in the hashing processes, so that the API worker keeps serving
+    the other requests meanwhile.
+    :raise HashingOverloaded: if PASSWORD_HASH_QUEUE hashes are already pending, or on timeout
+    """
+    if not _slots.acquire(blocking=False):
+        raise HashingOverloaded("Too many authentication requests, retry later")
+    executor = _get_executor()
+    try:
+        future = executor.submit(fn, *args)
+    except BrokenProcessPool:
+        _slots.release()
+        _reset_executor(executor)
+        raise
+    except Exception:
+        _slots.release()
+        raise
+    # The slot is freed when the hash is done, not when the request gives up
+    future.add_done_callback(lambda _: _slots.release())
+
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        raise HashingOverloaded("Authentication timed out, retry later")
+    except BrokenProcessPool:
+        logger.error("❌ Password hashing process crashed, restarting the pool")
+        _reset_executor(executor)
+        raise
+
+
+def hash_password(password):
+    """
+    :param password: plain password
+    :return: hash to store, with PASSWORD_HASH_METHOD
+    :raise HashingOverloaded: see _run
+    """
+    return _run(_hash, password, PASSWORD_HASH_METHOD)
+
+
+def check_password(stored_hash, password):
+    """
+    Checks a password, and hashes it again if the stored hash doesn't use
+    PASSWORD_HASH_METHOD (older or weaker parameters).
+    :param stored_hash: hash from the users table
+    :param password: plain password
+    :return: (True if the password matches, new hash to store or None)
+    :raise HashingOverloaded: see _run
+    """
+    return _run(_check, stored_hash, password, PASSWORD_HASH_METHOD)
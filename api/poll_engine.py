@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "60"))
+POLL_CALL_TIMEOUT = float(os.getenv("POLL_CALL_TIMEOUT", "15"))
+POLL_CYCLE_DEADLINE = float(os.getenv("POLL_CYCLE_DEADLINE", "50"))
+VENDOR_CONCURRENCY = {
+    "Dexcom": int(os.getenv("POLL_DEXCOM_CONCURRENCY", "8")),
+    "LibreLinkUp": int(os.getenv("POLL_LIBRE_CONCURRENCY", "8")),
+}
+DEFAULT_VENDOR_CONCURRENCY = 4
+
+_SKIPPED = object()
+
+
+class PollingEngine:
+    """
+    Fans out vendor calls of a polling cycle on bounded worker pools, one per
+    vendor: a backlog of one vendor never delays the calls of the others.
+    Each pool is sized by the concurrency limit of its vendor, each call gets
+    its own timeout, and the whole cycle is bounded by a deadline: a cycle
+    costs about as much as its slowest call instead of the sum of all of them.
+    Calls abandoned after their timeout keep their worker until the HTTP
+    timeout of the vendor client ends them (see VENDOR_HTTP_TIMEOUT in api/vendors.py).
+    """
+
+    def __init__(self, vendor_limits=None, call_timeout=POLL_CALL_TIMEOUT, cycle_deadline=POLL_CYCLE_DEADLINE):
+        self.vendor_limits = dict(vendor_limits or VENDOR_CONCURRENCY)
+        self.call_timeout = call_timeout
+        self.cycle_deadline = cycle_deadline
+
+        self._executors = {}
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._started_at = {}
+
+    def _executor(self, vendor):
+        with self._lock:
+            if vendor not in self._executors:
+                self._executors[vendor] = ThreadPoolExecutor(
+                    max_workers=self.vendor_limits.get(
+                        vendor, DEFAULT_VENDOR_CONCURRENCY),
+                    thread_name_prefix=f"cgm-poll-{vendor}")
+            return self._executors[vendor]
+
+    def _run(self, key, fn, deadline):
+        # Waited in the queue of its vendor until the end of the cycle
+        if monotonic() >= deadline:
+            return _SKIPPED
+        with self._lock:
+            self._started_at[key] = monotonic()
+        return fn()
+
+    def _release(self, key):
+        with self._lock:
+            self._in_flight.discard(key)
+            self._started_at.pop(key, None)
+
+    def run_cycle(self, calls):
+        """
+        Runs one polling cycle.
+        :param calls: iterable of (key, vendor, callable) tuples, key being unique per account
+        :return: (results, stats) where results is a dict {key: value} of the calls that finished in time
+        """
+        start = monotonic()
+        deadline = start + self.cycle_deadline
+        stats = {"calls": 0, "done": 0, "timeouts": 0,
+                 "skipped": 0, "errors": 0}
+
+        pending = {}
+        for key, vendor, fn in calls:
+            with self._lock:
+                # The previous call for this account is still hanging: don't pile up.
+                if key in self._in_flight:
+                    stats["skipped"] += 1
+                    continue
+                self._in_flight.add(key)
+            future = self._executor(vendor).submit(self._run, key, fn, deadline)
+            future.add_done_callback(lambda _, key=key: self._release(key))
+            pending[future] = key
+            stats["calls"] += 1
+
+        results = {}
+        while pending:
+            now = monotonic()
+            if now >= deadline:
+                break
+
+            # Abandon calls running for longer than the per-call timeout
+            with self._lock:
+                expired = [future for future, key in pending.items()
+                           if key in self._started_at and now - self._started_at[key] >= self.call_timeout]
+                next_expiry = min((self._started_at[key] + self.call_timeout
+                                   for key in pending.values() if key in self._started_at), default=deadline)
+            for future in expired:
+                del pending[future]
+                stats["timeouts"] += 1
+            if not pending:
+                break
+
+            done, _ = wait(pending, timeout=max(0, min(next_expiry, deadline) - now),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    value = future.result()
+                except Exception as e:
+                    logger.error("❌ Polling error for %s: %s", key, e)
+                    stats["errors"] += 1
+                    continue
+                if value is _SKIPPED:
+                    stats["skipped"] += 1
+                    continue
+                results[key] = value
+                stats["done"] += 1
+
+        # Cycle deadline reached: forget about the remaining calls
+        for future in pending:
+            if future.cancel():
+                stats["skipped"] += 1
+            else:
+                stats["timeouts"] += 1
+
+        stats["duration"] = monotonic() - start
+        return results, stats
+
+    def shutdown(self):
+        with self._lock:
+            executors = list(self._executors.values())
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,201 @@
+import logging
+import threading
+from functools import partial
+from time import monotonic, perf_counter, time
+
+from .backfill import BACKFILL_GAP, start_backfill
+from .credentials import credentials
+from .influx import (INFLUX_RETENTION, after_flush, read_last_times,
+                     write_to_influx)
+from .metrics import (POLL_CALLS, POLL_CYCLE_SECONDS, TRACKED_CONNECTIONS,
+                      VENDOR_CALL_SECONDS, VENDOR_CALLS)
+from .poll_engine import POLL_INTERVAL, PollingEngine
+from .query_cache import notify_cgm_write
+from .registry import ClientRegistry
+from .scheduler import PollScheduler
+from .sharding import NodeMembership, owner
+from .vendors import VENDORS, reading_fields
+
+logger = logging.getLogger(__name__)
+
+
+def fetch(entry):
+    """
+    Fetches the current reading of a connection, timed per vendor and region
+    :param entry: ClientEntry
+    :return: Reading or None
+    """
+    labels = (entry.vendor, entry.region or "")
+    start = perf_counter()
+    outcome = "error"
+    try:
+        reading = VENDORS[entry.vendor][1](entry.client, entry.conn_id)
+        outcome = "none" if reading is None else "reading"
+        return reading
+    finally:
+        VENDOR_CALL_SECONDS.labels(*labels).observe(perf_counter() - start)
+        VENDOR_CALLS.labels(*labels, outcome).inc()
+
+
+class CGMPoller:
+    """
+    Polls the CGM connections when their sensor should have a new reading and
+    writes the readings to InfluxDB
+    """
+
+    def __init__(self):
+        self.registry = ClientRegistry(
+            {conn_type: make_client for conn_type, (make_client, _) in VENDORS.items()})
+        self.engine = PollingEngine()
+        self.scheduler = PollScheduler()
+        # conn_id -> time of the last reading written, to skip the ones already stored
+        # (None if the connection has none yet)
+        self._last_written = {}
+
+    def refresh(self):
+        # Only the connections added, changed or removed since the last refresh.
+        # No login here: persisted sessions are reused, new ones are created on first poll
+        self.registry.refresh()
+        self.scheduler.sync(
+            {entry.conn_id: (entry.vendor, entry.updated_at) for entry in self.registry})
+        self._last_written = {conn_id: written_at for conn_id, written_at in self._last_written.items()
+                              if self.registry.get(conn_id) is not None}
+        self.load_last_written()
+        for vendor in VENDORS:
+            TRACKED_CONNECTIONS.labels(vendor).set(
+                sum(entry.vendor == vendor for entry in self.registry))
+        # Decrypted secrets are only kept for the polled connections
+        credentials.retain(entry.conn_id for entry in self.registry)
+        credentials.rotate_pending()
+
+    def load_last_written(self):
+        """
+        Reads the last reading stored for the connections new to this node
+        (poller start, shard rebalance, new connection), so that only a real
+        gap in their readings triggers a backfill
+        """
+        unknown = [entry for entry in self.registry if entry.conn_id not in self._last_written]
+        if not unknown:
+            return
+        try:
+            stored = read_last_times(f"-{INFLUX_RETENTION}")
+        except Exception as e:
+            # Tried again at the next refresh, no backfill meanwhile
+            logger.error("❌ Can't read the last stored readings: %s", e)
+            return
+        for entry in unknown:
+            self._last_written[entry.conn_id] = stored.get((str(entry.user_id), entry.vendor))
+
+    def run_cycle(self):
+        """
+        Fetches the connections that are due.
+        :return: stats of the polling engine, None if nothing was due
+        """
+        due = [entry for entry in map(self.registry.get, self.scheduler.pop_due())
+               if entry is not None]
+        if not due:
+            return None
+
+        # Actualize CGM Data
+        calls = [((entry.vendor, entry.conn_id), entry.vendor, partial(fetch, entry))
+                 for entry in due]
+
+        results, stats = self.engine.run_cycle(calls)
+        POLL_CYCLE_SECONDS.observe(stats["duration"])
+        for result in ("done", "timeouts", "skipped", "errors"):
+            POLL_CALLS.labels(result).inc(stats[result])
+
+        written = {}
+        for entry in due:
+            reading = results.get((entry.vendor, entry.conn_id))
+            # Errors, timeouts and missing readings back off
+            if reading is None:
+                self.scheduler.failed(entry.conn_id)
+                continue
+            self.scheduler.succeeded(entry.conn_id, reading.time)
+            # Reading already written by a previous fetch (of this node, or stored
+            # before it took the connection over, see load_last_written)
+            last_written = self._last_written.get(entry.conn_id)
+            if last_written is not None and reading.time <= last_written:
+                continue
+            self._last_written[entry.conn_id] = reading.time
+            # The connection couldn't be polled for a while: fill the gap. Without
+            # any stored reading it is new, its history was imported when it was added
+            if last_written is not None and (reading.time - last_written).total_seconds() > BACKFILL_GAP:
+                start_backfill(entry.conn_id, entry.user_id, entry.vendor)
+            write_to_influx(
+                measurement="glucose",
+                tags={
+                    "user_id": entry.user_id, "device": entry.vendor},
+                fields=reading_fields(reading),
+                timestamp=reading.time,
+            )
+            written.setdefault(entry.user_id, []).append(reading)
+        if written:
+            # API workers drop their cached queries once the points can be read:
+            # notified by the writer thread, the next cycles don't wait for InfluxDB
+            after_flush(partial(notify_cgm_write, written))
+
+        if stats["timeouts"] or stats["skipped"] or stats["errors"]:
+            logger.warning(
+                "⏳ CGM poll cycle: %s/%s calls done in %.1fs (%s timeouts, %s skipped, %s errors)",
+                stats['done'], stats['calls'], stats['duration'], stats['timeouts'], stats['skipped'], stats['errors'])
+        stats["written"] = sum(map(len, written.values()))
+        return stats
+
+
+def run(stop=None):
+    """
+    Polls CGM data as scheduled by PollScheduler. The connections and the
+    poller nodes are refreshed every POLL_INTERVAL seconds. Several pollers can
+    run at the same time: each one polls its own shard of the connections,
+    given by the nodes alive in the "poller_nodes" table.
+    :param stop: threading.Event stopping the poller, optional
+    """
+    stop = stop or threading.Event()
+    poller = CGMPoller()
+    membership = NodeMembership()
+    nodes = None
+    next_refresh = monotonic()
+
+    while not stop.is_set():
+        if monotonic() >= next_refresh:
+            # Next refresh POLL_INTERVAL seconds after this one started, whatever its duration
+            next_refresh = monotonic() + POLL_INTERVAL
+            try:
+                alive = membership.heartbeat()
+                if alive != nodes:
+                    nodes = alive
+                    poller.registry.set_owner(
+                        lambda conn_id, nodes=alive: owner(conn_id, nodes) == membership.node_id)
+                    logger.info("♻️ Poller node %s: %s node(s) alive, rebalancing connections", membership.node_id, len(nodes))
+            except Exception as e:
+                logger.error("❌ Poller node heartbeat failed: %s", e)
+            # Without any heartbeat yet, this node doesn't know its shard
+            if nodes is not None:
+                poller.refresh()
+
+        try:
+            poller.run_cycle()
+        except Exception as e:
+            logger.exception("❌ CGM poll cycle failed: %s", e)
+
+        wait = next_refresh - monotonic()
+        next_due = poller.scheduler.next_due()
+        if next_due is not None:
+            wait = min(wait, next_due - time())
+        stop.wait(max(0, wait))
+
+    membership.leave()
+    poller.engine.shutdown()
+
+
+def start_in_background():
+    """
+    Runs the poller in a thread of the current process (single process deployments)
+    :return: threading.Event stopping it
+    """
+    stop = threading.Event()
+    threading.Thread(target=run, args=(stop,), name="cgm-poller",
+                     daemon=True).start()
+    return stop
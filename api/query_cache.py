@@ -0,0 +1,170 @@
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from .auth_cache import TTLCache
+from .db_conn import get_conn, listen
+from .recent_readings import RECENT_READINGS, recent_readings, to_micros
+
+logger = logging.getLogger(__name__)
+
+QUERY_CACHE = os.getenv("QUERY_CACHE", "true").lower() == "true"
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1000"))
+NOTIFY_CHANNEL = "cgm_write"
+# Raw points newer than the last cached one minus that are read again when
+# extending an entry, for devices lagging behind the others
+EXTEND_OVERLAP = timedelta(minutes=15)
+# Payload suffix of a write of past points (history backfill): entries can't be extended
+RESET = "reset"
+
+
+class CachedQuery:
+    """
+    Points of a /CGMData query over a window ending now, and the time of the
+    latest point of the user when they were read
+    """
+    __slots__ = ("points", "last_time", "stale")
+
+    def __init__(self, points, last_time):
+        self.points = points
+        self.last_time = last_time
+        # New points were written since
+        self.stale = False
+
+
+class QueryCache:
+    """
+    Cache of /CGMData results, keyed by (user_id, period, resolution, fields).
+    Entries are marked stale by the writes of the poller (PostgreSQL notifications
+    on the "cgm_write" channel, that also carry the new readings to the ring
+    buffers of api/recent_readings.py): raw entries are then extended with the
+    new points only, aggregated ones are read again. Without listener
+    connection, nothing is cached.
+    """
+
+    def __init__(self, store=None):
+        """
+        :param store: local store with get(key) -> (hit, value), put, invalidate and clear (TTLCache by default)
+        """
+        self.store = store or TTLCache(QUERY_CACHE_TTL, QUERY_CACHE_SIZE)
+        self.listening = False
+        self._keys = {}
+        # Notifications received per user, to spot the writes happening while an entry is being read
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def get(self, key):
+        if not self.listening:
+            return None
+        hit, entry = self.store.get(key)
+        return entry if hit else None
+
+    def put(self, key, entry, generation):
+        """
+        :param generation: value of `generation(user_id)` before the points were read,
+            the entry isn't stored if points were written meanwhile
+        """
+        if not self.listening:
+            return
+        # Stored under the lock: a notification received in between would
+        # otherwise bump the generation without finding the entry to mark stale
+        with self._lock:
+            if self._generations.get(key[0], 0) != generation:
+                return
+            self._keys.setdefault(key[0], set()).add(key)
+            self.store.put(key, entry)
+
+    def mark_stale(self, user_id, reset=False):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            keys = self._keys.pop(user_id, set())
+        for key in keys:
+            if reset:
+                self.store.invalidate(key)
+                continue
+            hit, entry = self.store.get(key)
+            if hit:
+                entry.stale = True
+                with self._lock:
+                    self._keys.setdefault(user_id, set()).add(key)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+        self.store.clear()
+
+    def _on_notify(self, payload):
+        user_id, _, rest = payload.partition(":")
+        self.mark_stale(user_id, rest == RESET)
+        if rest == RESET:
+            # Backfilled readings: the ring is loaded again from InfluxDB
+            recent_readings.forget(user_id)
+        elif rest:
+            for reading in rest.split(";"):
+                micros, value, trend = reading.split(",")
+                recent_readings.add(user_id, int(micros), float(
+                    value), int(trend) if trend else None)
+
+    def _on_connect(self):
+        # Writes may have been missed while disconnected
+        self.clear()
+        recent_readings.clear()
+        self.listening = recent_readings.listening = True
+
+    def _on_disconnect(self):
+        self.listening = recent_readings.listening = False
+        self.clear()
+        recent_readings.clear()
+
+
+query_cache = QueryCache()
+
+
+def write_payload(user_id, readings):
+    """
+    :param readings: Readings written for the user, sent along for the ring buffers of the API workers
+    :return: notification payload, "<user_id>:<micros>,<value>,<trend>;..."
+    """
+    payload = f"{user_id}"
+    if readings:
+        payload += ":" + ";".join(
+            f"{to_micros(reading.time)},{reading.value},{'' if reading.trend is None else reading.trend}"
+            for reading in readings)
+    return payload
+
+
+def notify_cgm_write(writes, reset=False):
+    """
+    Tells the API workers that points were written for these users.
+    To be called once the points are in InfluxDB.
+    :param writes: dict {user_id: list of the Readings written}, or iterable of user ids
+    :param reset: True if past points were written (history backfill)
+    """
+    if not writes:
+        return
+    readings = writes if isinstance(writes, dict) else {}
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            for user_id in writes:
+                cur.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL,
+                            f"{user_id}:{RESET}" if reset else write_payload(user_id, readings.get(user_id))))
+    except Exception as e:
+        logger.error("❌ Can't notify CGM writes: %s", e)
+
+
+def start_cgm_write_listener():
+    """
+    Starts the background thread updating the query cache and the recent
+    readings on writes (only if QUERY_CACHE or RECENT_READINGS is enabled)
+    """
+    if not (QUERY_CACHE or RECENT_READINGS):
+        return
+    threading.Thread(target=listen, args=(NOTIFY_CHANNEL, query_cache._on_notify,
+                                          query_cache._on_connect, query_cache._on_disconnect),
+                     name="cgm-write-listener", daemon=True).start()
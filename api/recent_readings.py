@@ -0,0 +1,179 @@
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from .influx import iter_points
+
+RECENT_READINGS = os.getenv("RECENT_READINGS", "true").lower() == "true"
+# Span and capacity of each ring: 24h at one reading per minute
+RECENT_READINGS_SPAN = timedelta(hours=24)
+# Rings are loaded a bit further back than the span, so that a 24h window
+# computed a moment before the load is covered
+RECENT_READINGS_MARGIN = timedelta(minutes=5)
+RECENT_READINGS_CAPACITY = int(os.getenv("RECENT_READINGS_CAPACITY", "1440"))
+RECENT_READINGS_USERS = int(os.getenv("RECENT_READINGS_USERS", "1000"))
+RING_FIELDS = ("value", "trend")
+NO_TREND = -1
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_micros(dt):
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+class ReadingRing:
+    """
+    Recent readings of a user, sorted by time in compact arrays
+    (about 17 bytes per reading). The oldest ones are dropped past `capacity`.
+    """
+
+    def __init__(self, capacity=RECENT_READINGS_CAPACITY):
+        self.capacity = capacity
+        self.times = array("q")
+        self.values = array("d")
+        self.trends = array("b")
+        # Readings older than that may be missing (not loaded, or dropped)
+        self.covered_since = None
+        self.lock = threading.Lock()
+
+    def add(self, micros, value, trend=None):
+        trend = NO_TREND if trend is None else trend
+        with self.lock:
+            if not self.times or micros > self.times[-1]:
+                self.times.append(micros)
+                self.values.append(value)
+                self.trends.append(trend)
+            else:
+                # Late reading (another device of the user), or already there
+                index = bisect_left(self.times, micros)
+                if index < len(self.times) and self.times[index] == micros:
+                    self.values[index] = value
+                    self.trends[index] = trend
+                else:
+                    self.times.insert(index, micros)
+                    self.values.insert(index, value)
+                    self.trends.insert(index, trend)
+            # Arrays are trimmed by chunks, so that dropping is amortized O(1)
+            if len(self.times) >= 2 * self.capacity:
+                excess = len(self.times) - self.capacity
+                del self.times[:excess]
+                del self.values[:excess]
+                del self.trends[:excess]
+                if self.covered_since is not None:
+                    self.covered_since = max(self.covered_since, self.times[0])
+
+    def last_time(self):
+        with self.lock:
+            return from_micros(self.times[-1]) if self.times else None
+
+    def points(self, start, after=None, fields=RING_FIELDS):
+        """
+        :param start: aware datetime, included
+        :param after: aware datetime, excluded, optional
+        :return: list of (time, field, stat, value) tuples, as read from InfluxDB
+        """
+        with self.lock:
+            first = bisect_left(self.times, to_micros(start))
+            if after is not None:
+                first = max(first, bisect_right(self.times, to_micros(after)))
+            times = self.times[first:]
+            values = self.values[first:]
+            trends = self.trends[first:]
+        result = []
+        for micros, value, trend in zip(times, values, trends):
+            time = from_micros(micros)
+            if "value" in fields:
+                result.append((time, "value", None, value))
+            if "trend" in fields and trend != NO_TREND:
+                result.append((time, "trend", None, trend))
+        return result
+
+
+class RecentReadings:
+    """
+    Ring buffers of the users recently asking for their data, filled by the
+    poller writes (see api/query_cache.py) after a first load from InfluxDB.
+    """
+
+    def __init__(self, max_users=RECENT_READINGS_USERS):
+        self.max_users = max_users
+        self.listening = False
+        self._rings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, user_id, micros, value, trend=None):
+        # Only the rings already loaded: the other users aren't looking
+        with self._lock:
+            ring = self._rings.get(user_id)
+        if ring is not None:
+            ring.add(micros, value, trend)
+
+    def clear(self):
+        with self._lock:
+            self._rings.clear()
+
+    def forget(self, user_id):
+        """
+        Drops the ring of a user (past readings were written), reloaded on next use
+        """
+        with self._lock:
+            self._rings.pop(user_id, None)
+
+    def ring(self, user_id):
+        """
+        :return: the ring of a user, loaded from InfluxDB on first use (errors are raised)
+        """
+        with self._lock:
+            ring = self._rings.get(user_id)
+            if ring is not None:
+                self._rings.move_to_end(user_id)
+                if ring.covered_since is not None:
+                    return ring
+            else:
+                ring = self._rings[user_id] = ReadingRing()
+                while len(self._rings) > self.max_users:
+                    self._rings.popitem(last=False)
+
+        # Readings written meanwhile are already added to the ring
+        start = datetime.now(timezone.utc) - RECENT_READINGS_SPAN - RECENT_READINGS_MARGIN
+        readings = {}
+        for time, field, _, value in iter_points(user_id, "glucose", start=start, fields=list(RING_FIELDS)):
+            readings.setdefault(time, {})[field] = value
+        for time in sorted(readings):
+            if "value" in readings[time]:
+                trend = readings[time].get("trend")
+                ring.add(to_micros(time), readings[time]["value"],
+                         None if trend is None else int(trend))
+        ring.covered_since = to_micros(start)
+        return ring
+
+    def window(self, user_id, query):
+        """
+        Serves a /CGMData query from the ring of the user, if it can.
+        :param query: arguments of the query (see plan_query in api/routes/CGMData.py)
+        :return: (points, time of the latest reading), None if the query needs InfluxDB
+        """
+        if not (RECENT_READINGS and self.listening):
+            return None
+        fields = query["fields"] or ["value"]
+        if query["resolution"] is not None or query["stop"] is not None or not set(fields) <= set(RING_FIELDS):
+            return None
+        start = query["start"]
+        if start < datetime.now(timezone.utc) - RECENT_READINGS_SPAN - RECENT_READINGS_MARGIN:
+            return None
+
+        ring = self.ring(user_id)
+        if to_micros(start) < ring.covered_since:
+            return None
+        return ring.points(start, query["after"], fields), ring.last_time()
+
+
+recent_readings = RecentReadings()
@@ -0,0 +1,139 @@
+import logging
+from datetime import timedelta
+
+from .db_conn import get_conn
+
+logger = logging.getLogger(__name__)
+
+# Rows updated by transactions still running during the previous sync are
+# caught up by looking back a bit further than the last sync
+SYNC_OVERLAP = timedelta(minutes=5)
+
+
+class ClientEntry:
+    """
+    A polled connection and its vendor client
+    """
+    __slots__ = ("conn_id", "user_id", "vendor", "region", "client", "updated_at")
+
+    def __init__(self, conn_id, user_id, vendor, region, client, updated_at):
+        self.conn_id = conn_id
+        self.user_id = user_id
+        self.vendor = vendor
+        self.region = region
+        self.client = client
+        self.updated_at = updated_at
+
+
+class ClientRegistry:
+    """
+    Vendor clients of the "connections" table, keyed by connection id.
+    Each refresh only reads the rows added or changed since the previous one
+    (see the "updated_at" column), plus a row count to detect deletions.
+    Only the connections accepted by `owns` get a client (see api/sharding.py).
+    """
+
+    def __init__(self, factories, owns=None):
+        """
+        :param factories: dict {connection type: function(row) -> client}
+        :param owns: function(conn_id) -> bool, the connections to poll (all by default)
+        """
+        self.factories = factories
+        self.owns = owns or (lambda conn_id: True)
+        self._entries = {}
+        # Ids of every row, owned or not, whose entry is up to date
+        self._known = set()
+        self._synced_at = None
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, conn_id):
+        return self._entries.get(conn_id)
+
+    def set_owner(self, owns):
+        """
+        Changes the connections to poll: the ones not owned anymore are dropped
+        and the next refresh reloads the whole table to pick up the new ones.
+        """
+        self.owns = owns
+        for conn_id in list(self._entries):
+            if not owns(conn_id):
+                del self._entries[conn_id]
+        self._known.clear()
+        self._synced_at = None
+
+    def _upsert(self, row):
+        if not self.owns(row["id"]):
+            self._entries.pop(row["id"], None)
+            self._known.add(row["id"])
+            return False
+        entry = self._entries.get(row["id"])
+        if entry is not None and entry.updated_at == row["updated_at"]:
+            self._known.add(row["id"])
+            return False
+        try:
+            client = self.factories[row["type"]](row)
+        except Exception as e:
+            logger.error("❌ Can't create client for connection %s: %s", row['id'], e)
+            return False
+        self._entries[row["id"]] = ClientEntry(
+            row["id"], row["user_id"], row["type"], row["region"], client, row["updated_at"])
+        self._known.add(row["id"])
+        return True
+
+    def _select(self, cur, condition, params):
+        cur.execute(f"""
+            SELECT id, user_id, username, password, token, type, region, account_id, updated_at
+            FROM connections
+            WHERE type = ANY(%s) {condition}
+        """, [list(self.factories), *params])
+        columns = [desc[0] for desc in cur.description]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    def refresh(self):
+        """
+        Applies the connections added, changed or removed since the last refresh.
+        :return: (added or changed count, removed count)
+        """
+        types = list(self.factories)
+        try:
+            with get_conn() as conn, conn.cursor() as cur:
+                cur.execute("SELECT now()")
+                now = cur.fetchone()[0]
+
+                if self._synced_at is None:
+                    rows = self._select(cur, "", [])
+                else:
+                    rows = self._select(cur, "AND updated_at > %s", [
+                                        self._synced_at - SYNC_OVERLAP])
+                changed = sum(self._upsert(row) for row in rows)
+
+                # Every remaining row should be known by now: a different count
+                # means deletions (or rows whose client couldn't be created)
+                removed = 0
+                cur.execute(
+                    "SELECT count(*) FROM connections WHERE type = ANY(%s)", (types,))
+                if cur.fetchone()[0] != len(self._known):
+                    cur.execute(
+                        "SELECT id FROM connections WHERE type = ANY(%s)", (types,))
+                    ids = {row[0] for row in cur.fetchall()}
+                    self._known &= ids
+                    for conn_id in list(self._entries):
+                        if conn_id not in ids:
+                            del self._entries[conn_id]
+                            removed += 1
+                    missing = [conn_id for conn_id in ids if conn_id not in self._known]
+                    if missing:
+                        rows = self._select(cur, "AND id = ANY(%s)", [missing])
+                        changed += sum(self._upsert(row) for row in rows)
+
+            self._synced_at = now
+            return changed, removed
+
+        except Exception as e:
+            logger.error("❌ Reading error: %s", e)
+            return 0, 0
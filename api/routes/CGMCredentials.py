@@ -1,20 +1,19 @@
-import os
+import logging
 
 import psycopg
-from cryptography.fernet import Fernet
 from flask import Blueprint, jsonify, request
 from libre_link_up import LibreLinkUpClient
-from pydexcom import Dexcom
 from werkzeug.security import generate_password_hash
 
+from ..backfill import start_backfill
+from ..credentials import credentials as credential_store
 from ..db_conn import get_conn
 from ..server import token_required
+from ..vendors import ResumableDexcom
 
-bp = Blueprint("CGMCredentials", __name__)
-db_conn = get_conn()
+logger = logging.getLogger(__name__)
 
-FERNET_KEY = os.getenv("FERNET_KEY").encode()
-f = Fernet(FERNET_KEY)
+bp = Blueprint("CGMCredentials", __name__)
 
 
 @bp.route("/CGMCredentials", methods=['POST', 'GET', 'DELETE'])
@@ -24,49 +23,59 @@ def credentials(payload):
     if request.method == 'POST':
         data = request.get_json()
 
+        # The session opened to check the credentials is kept for polling
+        token, account_id, client = None, None, None
         try:
             match data.get("type"):
                 case "Dexcom":
                     region = data['region']
                     if not (data['region'] == 'us' and data['region'] == 'jp'):
                         region = 'ous'
-                    Dexcom(
+                    # With the HTTP timeouts of the poller's clients
+                    client = ResumableDexcom(
                         username=data['username'],
                         password=data['password'],
                         region=region
                     )
+                    # Logs in now, to check the credentials
+                    client._get_session()
+                    token, account_id = client._session_id, client.account_id
                 case "LibreLinkUp":
-                    LibreLinkUpClient(
+                    client = LibreLinkUpClient(
                         username=data['username'],
                         password=data['password'],
                         url=f"https://api-{data['region']}.libreview.io",
                         version="4.14.0",
-                    ).login()
+                    )
+                    client.login()
+                    token, account_id = client.jwt_token, client.headers.get(
+                        "Account-Id")
         except Exception as e:
-            print(e)
+            logger.warning("❌ Can't connect to %s: %s", data.get("type"), e)
             return jsonify({"error": f"Can't connect to {data.get("type")}.\n{e}"}), 500
 
         try:
-            with db_conn.cursor() as cur:
+            with get_conn() as conn, conn.cursor() as cur:
                 cur.execute(
-                    "INSERT INTO connections (user_id, username, password, type, region) VALUES (%s, %s, %s, %s, %s)",
-                    (payload["user_id"], data.get("username"), f.encrypt(data.get("password").encode()).decode(),
-                     data.get("type"), data.get("region"))
+                    "INSERT INTO connections (user_id, username, password, token, type, account_id, region) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id",
+                    (payload["user_id"], data.get("username"), credential_store.encrypt(data.get("password")),
+                     credential_store.encrypt(token),
+                     data.get("type"), account_id, data.get("region"))
                 )
-            db_conn.commit()
+                conn_id = cur.fetchone()[0]
+            # Imports the last hours with the session opened above
+            start_backfill(conn_id, payload["user_id"], data.get("type"), client)
             return jsonify({"message": f"Connection added to user {payload['user_id']}."}), 201
 
         except psycopg.errors.UniqueViolation:
-            db_conn.rollback()
             return jsonify({"error": "Connection already exists."}), 409
 
         except Exception as e:
-            db_conn.rollback()
             return jsonify({"error": f"Internal Error : {str(e)}"}), 500
 
     elif request.method == 'GET':
         try:
-            with db_conn.cursor() as cur:
+            with get_conn() as conn, conn.cursor() as cur:
                 cur.execute(
                     "SELECT id, username, type, region FROM connections WHERE user_id=%s",
                     (payload["user_id"],)
@@ -83,7 +92,7 @@ def credentials(payload):
         try:
             data = request.get_json()
 
-            with db_conn.cursor() as cur:
+            with get_conn() as conn, conn.cursor() as cur:
                 cur.execute(
                     "SELECT c.type, u.name FROM connections c JOIN users u ON c.user_id = u.id WHERE c.id=%s",
                     (data.get("id"),)
@@ -98,9 +107,7 @@ def credentials(payload):
                     "DELETE FROM connections WHERE id=%s",
                     (data.get("id"),)
                 )
-            db_conn.commit()
             return jsonify({"message": f"Connection {c_type} deleted for user {c_name}."}), 200
 
         except Exception as e:
-            db_conn.rollback()
             return jsonify({"error": f"Internal Error : {str(e)}"}), 500
@@ -1,34 +1,365 @@
-from flask import Blueprint, jsonify, request
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta, timezone
 
-from ..db_conn import get_conn
-from ..influx import read_from_influx
+from flask import Blueprint, Response, jsonify, make_response, request
+
+from .. import cgm_format
+from ..influx import (FIELD_FORMAT, RESOLUTION_FORMAT, iter_points,
+                      point_to_dict, read_last_time, read_points,
+                      read_points_and_last_time)
+from ..query_cache import EXTEND_OVERLAP, QUERY_CACHE, CachedQuery, query_cache
+from ..recent_readings import recent_readings
 from ..server import token_required
 
+logger = logging.getLogger(__name__)
+
 bp = Blueprint("CGMData", __name__)
-db_conn = get_conn()
+
+PERIODS = {
+    "d": timedelta(days=1),
+    "w": timedelta(weeks=1),
+    "m": timedelta(days=30),
+    "y": timedelta(days=365),
+}
+
+# Default aggregation window depending on the span of the requested window,
+# so that long periods only return a few thousand points
+AUTO_RESOLUTIONS = [
+    (timedelta(days=1), None),
+    (timedelta(weeks=1), "10m"),
+    (timedelta(days=31), "1h"),
+]
+MAX_AUTO_RESOLUTION = "6h"
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Fields returned when none is asked for, the others (ex: "trend") are opt-in
+DEFAULT_FIELDS = ["value"]
+
+# Readings older than that aren't "latest" anymore
+LATEST_WINDOW = timedelta(hours=1)
+
+# Points encoded between two writes of a streamed response
+STREAM_CHUNK_SIZE = 1000
+
+
+def parse_timestamp(value):
+    """
+    Parses an ISO 8601 date or a unix timestamp (seconds) into an aware datetime
+    """
+    try:
+        return datetime.fromtimestamp(float(value), tz=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        pass
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def encode_cursor(dt):
+    """
+    Compact cursor for the "since" sync: base36 unix time in microseconds
+    """
+    micros = (dt - EPOCH) // timedelta(microseconds=1)
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    cursor = ""
+    while micros:
+        micros, rest = divmod(micros, 36)
+        cursor = digits[rest] + cursor
+    return cursor or "0"
+
+
+def decode_cursor(cursor):
+    try:
+        return EPOCH + timedelta(microseconds=int(cursor, 36))
+    except (ValueError, OverflowError):
+        raise ValueError("Invalid cursor")
+
+
+def auto_resolution(span):
+    for max_span, resolution in AUTO_RESOLUTIONS:
+        if span <= max_span:
+            return resolution
+    return MAX_AUTO_RESOLUTION
+
+
+def plan_query(args):
+    """
+    Turns the GET parameters of /CGMData into the arguments of the one query to run.
+    :param args: request.args
+    :return: dict {start, stop, resolution, fields, after}
+    """
+    period = args.get("period", "d")
+    if period not in PERIODS:
+        raise ValueError("Invalid period (values: 'd', 'w', 'm', 'y')")
+
+    now = datetime.now(timezone.utc)
+    stop = parse_timestamp(args["stop"]) if args.get("stop") else None
+
+    # Incremental sync: only the points newer than the cursor
+    after = None
+    if args.get("cursor"):
+        after = decode_cursor(args["cursor"])
+    elif args.get("since"):
+        after = parse_timestamp(args["since"])
+
+    if after is not None:
+        start = after
+    elif args.get("start"):
+        start = parse_timestamp(args["start"])
+    else:
+        start = (stop or now) - PERIODS[period]
+    if start >= (stop or now):
+        raise ValueError("'start' must be before 'stop'")
+
+    resolution = args.get("resolution")
+    if resolution is None:
+        # New points of an incremental sync are returned as they are
+        resolution = auto_resolution(
+            (stop or now) - start) if after is None else None
+    elif resolution == "raw":
+        resolution = None
+    elif not RESOLUTION_FORMAT.match(resolution):
+        raise ValueError("Invalid resolution (ex: '5m', '1h', '1d' or 'raw')")
+
+    return {"start": start, "stop": stop, "resolution": resolution, "fields": parse_fields(args), "after": after}
+
+
+def parse_fields(args):
+    """
+    :return: fields asked for in the "fields" GET parameter, DEFAULT_FIELDS if none
+    """
+    if not args.get("fields"):
+        return DEFAULT_FIELDS
+    fields = args["fields"].split(",")
+    if not all(FIELD_FORMAT.match(field) for field in fields):
+        raise ValueError("Invalid fields (ex: 'value,trend')")
+    return fields
 
 
 @bp.route("/CGMData", methods=['GET'])
 @token_required
 def cgm_data(payload):
     try:
-        period = request.args.get("period")
+        query = plan_query(request.args)
+        fmt = cgm_format.negotiate(request.args, request.accept_mimetypes)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        data = read_from_influx(f"{payload["user_id"]}", "glucose")
+    try:
+        user_id = f"{payload["user_id"]}"
+        stream = request.args.get("stream", "").lower() in ("1", "true")
 
-        match period:
-            # day case already managed
-            case "w":
-                data = read_from_influx(
-                    f"{payload["user_id"]}", "glucose", 168)
-            case "m":
-                data = read_from_influx(
-                    f"{payload["user_id"]}", "glucose", 5040)
-            case "y":
-                data = read_from_influx(
-                    f"{payload["user_id"]}", "glucose", 1839600)
+        # Hot path: short raw windows come from the recent readings in memory
+        recent = None if stream else recent_readings.window(
+            user_id, with_overlap(query))
+        key = None if stream or recent else cache_key(
+            user_id, request.args, query)
+        if recent is not None:
+            points, last_time = recent
+        elif key is not None:
+            points, last_time = read_cached(user_id, query, key)
+        elif stream or query["after"] is not None or request.if_none_match:
+            # Cheap path: nothing was written since the client's last call
+            # (streamed responses need their ETag before the points are read)
+            points, last_time = None, read_last_time(
+                user_id, "glucose", start=query["start"])
+        else:
+            points, last_time = read_uncached(user_id, query)
+        etag = None
+        if last_time is not None:
+            if query["after"] is not None and last_time <= query["after"]:
+                return not_modified(None)
+            etag = hashlib.sha1(
+                f"{user_id}|{fmt}|{request.query_string.decode()}|{last_time.isoformat()}".encode()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
 
-        return jsonify({"message": f"CGM Data for user {payload['user_id']}", "data": data}), 200
+        if fmt == cgm_format.JSON and stream:
+            response = Response(stream_points(
+                user_id, query, f"CGM Data for user {payload['user_id']}"), mimetype="application/json")
+        else:
+            if points is None:
+                points = read_points(user_id, "glucose", **with_overlap(query))
+            response = make_data_response(
+                fmt, points, query, f"CGM Data for user {payload['user_id']}")
+        response.vary.add("Accept")
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
 
     except Exception as e:
         return jsonify({"error": f"Internal Error : {str(e)}"}), 500
+
+
+@bp.route("/CGMData/latest", methods=['GET'])
+@token_required
+def cgm_latest(payload):
+    try:
+        fields = parse_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        user_id = f"{payload["user_id"]}"
+        query = {"start": datetime.now(timezone.utc) - LATEST_WINDOW, "stop": None,
+                 "resolution": None, "fields": fields, "after": None}
+        recent = recent_readings.window(user_id, query)
+        points = recent[0] if recent is not None else read_points(
+            user_id, "glucose", **query)
+
+        latest = {}
+        for time, field, _, value in points:
+            if not latest or time > latest["time"]:
+                latest = {"time": time}
+            if time == latest["time"]:
+                latest[field] = value
+        if not latest:
+            return jsonify({"error": f"No reading in the last {LATEST_WINDOW}."}), 404
+        latest["time"] = latest["time"].isoformat()
+        response = jsonify(
+            {"message": f"Latest CGM reading for user {payload['user_id']}", "data": latest})
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response, 200
+
+    except Exception as e:
+        return jsonify({"error": f"Internal Error : {str(e)}"}), 500
+
+
+def with_overlap(query):
+    """
+    Incremental syncs read again the points up to EXTEND_OVERLAP before their
+    cursor: points can be written after newer ones (history backfill, readings
+    uploaded late by the sensor), clients deduplicate them by time.
+    :return: arguments of the query to read
+    """
+    if query["after"] is None:
+        return query
+    return {**query, "start": query["start"] - EXTEND_OVERLAP,
+            "after": query["after"] - EXTEND_OVERLAP}
+
+
+def cache_key(user_id, args, query):
+    """
+    :return: key of the query in the result cache, None if it isn't cached
+        (only windows ending now are, explicit ones are rarely asked twice)
+    """
+    if not QUERY_CACHE or any(args.get(name) for name in ("start", "stop", "since", "cursor")):
+        return None
+    return (user_id, args.get("period", "d"), query["resolution"], tuple(query["fields"] or ()))
+
+
+def read_cached(user_id, query, key):
+    """
+    Reads the points of a query from the result cache, InfluxDB being only
+    queried for what was written since they were cached.
+    :return: (points, time of the latest point of the user)
+    """
+    entry = query_cache.get(key)
+    if entry is not None and entry.stale and query["resolution"] is not None:
+        # Aggregated windows changed: read again
+        entry = None
+    elif entry is not None and entry.stale:
+        # Raw points: only the new ones are read
+        generation = query_cache.generation(user_id)
+        since = max(entry.last_time - EXTEND_OVERLAP,
+                    query["start"]) if entry.last_time else query["start"]
+        new_points = list(iter_points(
+            user_id, "glucose", **{**query, "start": since}))
+        entry = CachedQuery([point for point in entry.points if point[0] < since] + new_points,
+                            max((point[0] for point in new_points), default=entry.last_time))
+        query_cache.put(key, entry, generation)
+
+    if entry is None:
+        generation = query_cache.generation(user_id)
+        entry = CachedQuery(*read_points_and_last_time(user_id, "glucose", **query))
+        query_cache.put(key, entry, generation)
+
+    # The window slid since the points were cached
+    return [point for point in entry.points if point[0] >= query["start"]], entry.last_time
+
+
+def read_uncached(user_id, query):
+    """
+    Reads the points of a query along with the time of the latest point of the user
+    :return: (points, time of the latest point), ([], None) on InfluxDB error
+    """
+    try:
+        return read_points_and_last_time(user_id, "glucose", **query)
+    except Exception as e:
+        logger.error("❌ Erreur lecture InfluxDB : %s", e)
+        return [], None
+
+
+def make_data_response(fmt, points, query, message):
+    cursor = query["after"]
+    if points and query["resolution"] is None:
+        latest = max(point[0] for point in points)
+        # The overlap read again before the cursor doesn't move it back
+        cursor = latest if cursor is None else max(cursor, latest)
+    next_cursor = encode_cursor(cursor) if cursor is not None else None
+
+    match fmt:
+        case cgm_format.BINARY:
+            response = make_response(cgm_format.encode_binary(points), 200)
+            response.mimetype = cgm_format.MIMETYPES[fmt]
+            if next_cursor is not None:
+                response.headers["X-Next-Cursor"] = next_cursor
+        case cgm_format.COLUMNAR:
+            body = {"message": message,
+                    "series": cgm_format.to_columns(points)}
+            if next_cursor is not None:
+                body["next_cursor"] = next_cursor
+            response = make_response(jsonify(body), 200)
+            response.mimetype = cgm_format.MIMETYPES[fmt]
+        case _:
+            body = {"message": message,
+                    "data": [point_to_dict(point) for point in points]}
+            if next_cursor is not None:
+                body["next_cursor"] = next_cursor
+            response = make_response(jsonify(body), 200)
+    return response
+
+
+def stream_points(user_id, query, message):
+    """
+    Encodes the JSON response of /CGMData while the points are read from InfluxDB,
+    so that memory use doesn't depend on the size of the range.
+    The next cursor comes after the data, and an `error` key ends the document
+    if InfluxDB fails midway.
+    """
+    yield f'{{"message": {json.dumps(message)}, "data": ['
+
+    cursor = query["after"]
+    chunk = []
+    separator = ""
+    try:
+        for point in iter_points(user_id, "glucose", **with_overlap(query)):
+            if query["resolution"] is None and (cursor is None or point[0] > cursor):
+                cursor = point[0]
+            chunk.append(separator + json.dumps(point_to_dict(point)))
+            separator = ","
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+    except Exception as e:
+        logger.error("❌ Erreur lecture InfluxDB : %s", e)
+        yield "".join(chunk) + f'], "error": {json.dumps("Internal Error : " + str(e))}}}'
+        return
+
+    end = "".join(chunk) + "]"
+    if cursor is not None:
+        end += f', "next_cursor": "{encode_cursor(cursor)}"'
+    yield end + "}"
+
+
+def not_modified(etag):
+    response = make_response("", 304)
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import numpy as np
+from flask import Blueprint, jsonify, request
+
+from ..influx import iter_series
+from ..server import token_required
+from .CGMData import PERIODS, parse_timestamp
+
+bp = Blueprint("CGMStats", __name__)
+
+STATS_PERIODS = {**PERIODS, "q": timedelta(days=90)}
+MAX_WINDOW = timedelta(days=366)
+
+# Readings are averaged over 5 minutes (the Dexcom cadence) up to 90 days,
+# over one hour beyond
+SERIES_STEPS = [
+    (timedelta(days=92), "5m", 300),
+]
+MAX_SERIES_STEP = ("1h", 3600)
+
+# Glycemic ranges in mmol/L (international consensus on time in range).
+# The target range includes its bounds: the ranges below it exclude their
+# upper bound, the ones above it their lower bound.
+TARGET_RANGE = (3.9, 10.0)
+RANGES = [
+    ("very_low", -np.inf, 3.0),
+    ("low", 3.0, 3.9),
+    ("in_range", 3.9, 10.0),
+    ("high", 10.0, 13.9),
+    ("very_high", 13.9, np.inf),
+]
+MMOL_TO_MGDL = 18.0182
+AGP_PERCENTILES = (5, 25, 50, 75, 95)
+AGP_BINS = (15, 30, 60, 120)
+
+
+def series_step(span):
+    for max_span, every, seconds in SERIES_STEPS:
+        if span <= max_span:
+            return every, seconds
+    return MAX_SERIES_STEP
+
+
+def in_range(values, low, high):
+    """
+    :return: boolean mask of the values in [low, high], bounds set by TARGET_RANGE
+    """
+    above = values > low if low >= TARGET_RANGE[1] else values >= low
+    below = values <= high if high > TARGET_RANGE[0] else values < high
+    return above & below
+
+
+def utc_offsets(times, tz):
+    """
+    UTC offset (seconds) of each timestamp, computed once per day of the window
+    :param times: int64 array of unix times (seconds)
+    """
+    days = np.unique(times // 86400)
+    offsets = np.array([
+        datetime.fromtimestamp(int(day) * 86400 + 43200, timezone.utc).astimezone(tz).utcoffset().total_seconds()
+        for day in days])
+    return offsets[np.searchsorted(days, times // 86400)].astype(np.int64)
+
+
+def glucose_stats(times, values, tz, agp_bin, step, window):
+    """
+    Computes the glucose metrics of a series.
+    :param times: int64 array of unix times (seconds)
+    :param values: float64 array of glucose values (mmol/L)
+    :param tz: ZoneInfo of the user, for the AGP time of day
+    :param agp_bin: width of the AGP time of day bins (minutes)
+    :param step: seconds between two values of the series
+    :param window: seconds of the requested window
+    :return: dict
+    """
+    mean = values.mean()
+    sd = values.std(ddof=1) if len(values) > 1 else 0.0
+    stats = {
+        "count": int(len(values)),
+        "mean": round(float(mean), 2),
+        "sd": round(float(sd), 2),
+        "cv": round(float(sd / mean * 100), 1),
+        # Glucose Management Indicator (%), from the mean in mg/dL
+        "gmi": round(float(3.31 + 0.02392 * mean * MMOL_TO_MGDL), 1),
+        "tir": {name: round(float(np.count_nonzero(in_range(values, low, high)) / len(values) * 100), 1)
+                for name, low, high in RANGES},
+    }
+
+    # Ambulatory glucose profile: percentiles of each time of day bin
+    local = times + utc_offsets(times, tz)
+    bins = (local % 86400) // (agp_bin * 60)
+    order = np.lexsort((values, bins))
+    bins, sorted_values = bins[order], values[order]
+    bounds = np.searchsorted(bins, np.arange(1440 // agp_bin + 1))
+    curves = {f"p{p}": [] for p in AGP_PERCENTILES}
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        quantiles = np.percentile(sorted_values[start:stop], AGP_PERCENTILES) if stop > start else [None] * len(AGP_PERCENTILES)
+        for p, quantile in zip(AGP_PERCENTILES, quantiles):
+            curves[f"p{p}"].append(None if quantile is None else round(float(quantile), 1))
+    stats["agp"] = {"bin": agp_bin, **curves}
+
+    stats["coverage"] = round(min(len(values) * step / window * 100, 100.0), 1)
+    return stats
+
+
+@bp.route("/CGMStats", methods=['GET'])
+@token_required
+def cgm_stats(payload):
+    try:
+        period = request.args.get("period", "w")
+        if period not in STATS_PERIODS:
+            raise ValueError("Invalid period (values: 'd', 'w', 'm', 'q', 'y')")
+        now = datetime.now(timezone.utc)
+        stop = parse_timestamp(request.args["stop"]) if request.args.get("stop") else now
+        start = parse_timestamp(request.args["start"]) if request.args.get("start") else stop - STATS_PERIODS[period]
+        if start >= stop:
+            raise ValueError("'start' must be before 'stop'")
+        if stop - start > MAX_WINDOW:
+            raise ValueError("The window can't be longer than one year")
+
+        tz = ZoneInfo(request.args.get("tz", "UTC"))
+        agp_bin = int(request.args.get("agp_bin", "60"))
+        if agp_bin not in AGP_BINS:
+            raise ValueError(f"Invalid agp_bin (values: {', '.join(map(str, AGP_BINS))})")
+    except (ValueError, ZoneInfoNotFoundError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        user_id = f"{payload["user_id"]}"
+        every, step = series_step(stop - start)
+
+        series = np.array(
+            [(time.timestamp(), value) for time, value in iter_series(user_id, every, start, stop)
+             if value is not None],
+            dtype=np.float64).reshape(-1, 2)
+
+        data = {"start": start.isoformat(), "stop": stop.isoformat()}
+        if len(series):
+            data.update(glucose_stats(series[:, 0].astype(
+                np.int64), series[:, 1], tz, agp_bin, step, (stop - start).total_seconds()))
+        else:
+            data["count"] = 0
+
+        response = jsonify(
+            {"message": f"CGM Stats for user {payload['user_id']}", "data": data})
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response, 200
+
+    except Exception as e:
+        return jsonify({"error": f"Internal Error : {str(e)}"}), 500
@@ -1,6 +1,5 @@
 import hashlib
 import os
-import smtplib
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 
@@ -8,15 +7,16 @@ import jwt
 import psycopg
 from dotenv import load_dotenv
 from flask import Blueprint, jsonify, make_response, request
-from werkzeug.security import check_password_hash, generate_password_hash
 
+from ..auth_cache import invalidate_password_change, notify_password_change
 from ..db_conn import get_conn
+from ..mailer import send_email
+from ..metrics import PASSWORD_HASHES_REJECTED
+from ..password_hashing import HashingOverloaded, check_password, hash_password
 from ..server import token_required
 
 bp = Blueprint("auth", __name__)
 
-db_conn = get_conn()
-
 load_dotenv()
 
 SECRET_KEY = os.getenv("JWT_SECRET")
@@ -26,6 +26,16 @@ FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173/")
 HTTPS_ENABLED = os.getenv("HTTPS", "false").lower() == "true"
 
 
+def overloaded(e):
+    """
+    503 response when password hashing is saturated, the client should retry later
+    """
+    PASSWORD_HASHES_REJECTED.inc()
+    resp = make_response(jsonify({"error": str(e)}), 503)
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+
 @bp.route("/login", methods=["POST"])
 def login():
     data = request.get_json()
@@ -37,14 +47,22 @@ def login():
         return jsonify({"error": "email et password requis"}), 400
 
     try:
-        with db_conn.cursor() as cur:
+        with get_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 "SELECT id, password, verified FROM users WHERE email = %s", (email,))
             result = cur.fetchone()
         if result is None:
             return jsonify({"error": "Wrong email"}), 404
         user_id, stored_hash, verified = result
-        if check_password_hash(stored_hash, password):
+        valid, new_hash = check_password(stored_hash, password)
+        if valid:
+            if new_hash is not None:
+                # Hash upgraded to the current PASSWORD_HASH_METHOD, unless changed meanwhile
+                with get_conn() as conn, conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE users SET password = %s WHERE id = %s AND password = %s",
+                        (new_hash, user_id, stored_hash))
+
             payload = {
                 "user_id": user_id,
                 "email": email,
@@ -69,13 +87,12 @@ def login():
                 token_hash = hashlib.sha256(raw_token.encode()).hexdigest()
 
                 expires = datetime.now() + timedelta(days=91)
-                with db_conn.cursor() as cur:
+                with get_conn() as conn, conn.cursor() as cur:
                     cur.execute(
                         "INSERT INTO remember_tokens (user_id, token_hash, expires_at, user_agent, ip_address) VALUES (%s, %s, %s, %s, %s)",
                         (user_id, token_hash, expires,
                          request.user_agent.string, request.remote_addr)
                     )
-                db_conn.commit()
 
                 resp.set_cookie(
                     "opengluco_remember_me",
@@ -90,6 +107,8 @@ def login():
         else:
             return jsonify({"error": "Wrong password"}), 401
 
+    except HashingOverloaded as e:
+        return overloaded(e)
     except Exception as e:
         return jsonify({"error": f"{str(e)}"}), 500
 
@@ -103,10 +122,11 @@ def signup():
     name = data.get("name")
     surname = data.get("surname")
     email = data.get("email")
-    password = generate_password_hash(data.get("password"))
+    if not data.get("password"):
+        return jsonify({"error": "password requis"}), 400
 
     try:
-        with db_conn.cursor() as cur:
+        with get_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 "SELECT id FROM users WHERE email = %s", (email,))
             result = cur.fetchone()
@@ -116,21 +136,24 @@ def signup():
     except Exception as e:
         return jsonify({"error": f"{str(e)}"}), 500
 
+    # Hashed once the email is known to be free, and before sending the verification email
+    try:
+        password = hash_password(data.get("password"))
+    except HashingOverloaded as e:
+        return overloaded(e)
+
     send_verification_email(email, name)
 
     try:
-        with db_conn.cursor() as cur:
+        with get_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 "INSERT INTO users (name, surname, email, password, created_at) VALUES (%s, %s, %s, %s, %s)",
                 (name, surname, email, password, datetime.now())
             )
-        db_conn.commit()
         return jsonify({"message": "User registered."}), 201
     except psycopg.errors.UniqueViolation:
-        db_conn.rollback()
         return jsonify({"error": "User already exists."}), 409
     except Exception as e:
-        db_conn.rollback()
         return jsonify({"error": f"Internal Error : {str(e)}"}), 500
 
 
@@ -145,15 +168,13 @@ def logout():
         token_hash = hashlib.sha256(raw_token.encode()).hexdigest()
 
         try:
-            with db_conn.cursor() as cur:
+            with get_conn() as conn, conn.cursor() as cur:
                 cur.execute(
                     "DELETE FROM remember_tokens WHERE token_hash = %s",
                     (token_hash,)
                 )
                 # TODO: fix bug, suppression marche pas
-            db_conn.commit()
         except Exception as e:
-            db_conn.rollback()
             return jsonify({"error": f"Internal Error : {str(e)}"}), 500
 
     resp.delete_cookie("opengluco_remember_me",
@@ -168,7 +189,7 @@ def forgot_password():
         return jsonify({"error": "Missing email"}), 400
 
     try:
-        with db_conn.cursor() as cur:
+        with get_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 "SELECT name, surname, email, id FROM users WHERE email = %s", (email,))
             result = cur.fetchone()
@@ -198,15 +219,18 @@ def update_password():
     try:
         jwt_data = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
         user_id = jwt_data["user_id"]
-        password = generate_password_hash(data.get("password"))
+        password = hash_password(data.get("password"))
 
-        with db_conn.cursor() as cur:
+        with get_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 "UPDATE users SET password = %s, last_password_change = %s WHERE id = %s", (password, datetime.now(), user_id))
-        db_conn.commit()
+            notify_password_change(cur, user_id)
+        invalidate_password_change(user_id)
 
         return jsonify({"message": "Successfully changed password."}), 200
 
+    except HashingOverloaded as e:
+        return overloaded(e)
     except jwt.ExpiredSignatureError:
         return jsonify({"error": "Expired link"}), 400
     except jwt.InvalidTokenError:
@@ -223,10 +247,9 @@ def verify_email():
         data = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
         email = data["email"]
 
-        with db_conn.cursor() as cur:
+        with get_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 "UPDATE users SET verified = TRUE WHERE email = %s", (email,))
-        db_conn.commit()
 
         return jsonify({"message": "Successfully verified account."}), 200
 
@@ -243,7 +266,7 @@ def ask_verify(payload):
     try:
         user_id = payload["user_id"]
 
-        with db_conn.cursor() as cur:
+        with get_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 "SELECT name, email FROM users WHERE id = %s", (user_id,))
             result = cur.fetchone()
@@ -277,9 +300,8 @@ def send_verification_email(to_email, name):
     msg["From"] = os.getenv("SMTP_FROM")
     msg["To"] = to_email
 
-    with smtplib.SMTP_SSL(os.getenv("SMTP_HOST"), int(os.getenv("SMTP_PORT"))) as server:
-        server.login(os.getenv("SMTP_USER"), os.getenv("SMTP_PASS"))
-        server.send_message(msg)
+    # Sent in the background, the request doesn't wait for the SMTP server
+    send_email(msg)
 
     # print(f"✅ Verification email sent to {to_email}")
 
@@ -303,8 +325,7 @@ def send_password_reset_email(to_email, user_id, name):
     msg["From"] = os.getenv("SMTP_FROM")
     msg["To"] = to_email
 
-    with smtplib.SMTP_SSL(os.getenv("SMTP_HOST"), int(os.getenv("SMTP_PORT"))) as server:
-        server.login(os.getenv("SMTP_USER"), os.getenv("SMTP_PASS"))
-        server.send_message(msg)
+    # Sent in the background, the request doesn't wait for the SMTP server
+    send_email(msg)
 
     # print(f"✅ Verification email sent to {to_email}")
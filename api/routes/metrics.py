@@ -0,0 +1,21 @@
+import hmac
+import os
+
+from flask import Blueprint, Response, jsonify, request
+
+from ..metrics import render_metrics
+
+bp = Blueprint("metrics", __name__)
+
+# Optional bearer token expected by /metrics (ex: set in the Prometheus scrape config)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+@bp.route("/metrics", methods=['GET'])
+def metrics():
+    if METRICS_TOKEN and not hmac.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"error": "Invalid token"}), 401
+
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
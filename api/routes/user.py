@@ -5,14 +5,12 @@ from ..server import token_required
 
 bp = Blueprint("user", __name__)
 
-db_conn = get_conn()
-
 
 @bp.route("/user", methods=["GET"])
 @token_required
 def user(payload):
     try:
-        with db_conn.cursor() as cur:
+        with get_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 "SELECT name, surname, email FROM users WHERE id = %s", (payload["user_id"],))
             result = cur.fetchone()
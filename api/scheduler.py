@@ -0,0 +1,117 @@
+import heapq
+import os
+import random
+from time import time
+
+from .poll_engine import POLL_INTERVAL
+
+# Seconds between two readings of a sensor: Dexcom shares a reading every
+# 5 minutes, LibreLinkUp every minute
+SENSOR_CADENCE = {
+    "Dexcom": float(os.getenv("POLL_DEXCOM_CADENCE", "300")),
+    "LibreLinkUp": float(os.getenv("POLL_LIBRE_CADENCE", "60")),
+}
+# Delay between the expected reading and the fetch, so that the vendor had time to publish it
+POLL_READING_DELAY = float(os.getenv("POLL_READING_DELAY", "20"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "10"))
+# Retry delay of a connection whose expected reading is late
+POLL_RETRY_INTERVAL = float(os.getenv("POLL_RETRY_INTERVAL", "30"))
+POLL_MAX_BACKOFF = float(os.getenv("POLL_MAX_BACKOFF", "900"))
+
+
+class PollScheduler:
+    """
+    Priority queue of the connections to poll, ordered by the time of their next fetch.
+    A connection is fetched just after its sensor is expected to have a new
+    reading, instead of every POLL_INTERVAL seconds; failing connections back off.
+    """
+
+    def __init__(self, cadences=None):
+        self.cadences = dict(cadences or SENSOR_CADENCE)
+        self._heap = []
+        # conn_id -> due time, the heap entries not matching it are stale
+        self._due = {}
+        self._vendors = {}
+        self._versions = {}
+        self._failures = {}
+
+    def __len__(self):
+        return len(self._due)
+
+    def _schedule(self, conn_id, due):
+        self._due[conn_id] = due
+        heapq.heappush(self._heap, (due, conn_id))
+
+    def sync(self, connections):
+        """
+        Adds the new connections, spread over the next POLL_INTERVAL seconds, and forgets the removed ones.
+        A connection whose version changed (new credentials) is fetched again soon, without backoff.
+        :param connections: dict {conn_id: (vendor, version)}
+        """
+        now = time()
+        for conn_id, (vendor, version) in connections.items():
+            if conn_id not in self._due:
+                self._schedule(conn_id, now + random.uniform(0, POLL_INTERVAL))
+            elif self._versions[conn_id] != version and self._due[conn_id] is not None:
+                self._failures.pop(conn_id, None)
+                self._schedule(conn_id, now + random.uniform(0, POLL_JITTER))
+            self._vendors[conn_id] = vendor
+            self._versions[conn_id] = version
+        for conn_id in [conn_id for conn_id in self._due if conn_id not in connections]:
+            del self._due[conn_id]
+            del self._vendors[conn_id]
+            del self._versions[conn_id]
+            self._failures.pop(conn_id, None)
+
+    def pop_due(self, now=None):
+        """
+        :return: ids of the connections to fetch now, they are rescheduled by `succeeded` or `failed`
+        """
+        now = time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due_at, conn_id = heapq.heappop(self._heap)
+            if self._due.get(conn_id) == due_at:
+                self._due[conn_id] = None
+                due.append(conn_id)
+        return due
+
+    def succeeded(self, conn_id, reading_time=None):
+        """
+        Schedules the next fetch just after the next expected reading.
+        :param reading_time: time of the last reading (aware datetime), None if unknown
+        """
+        if conn_id not in self._due:
+            return
+        self._failures.pop(conn_id, None)
+        now = time()
+        cadence = self.cadences.get(self._vendors[conn_id], POLL_INTERVAL)
+        if reading_time is None:
+            due = now + cadence
+        else:
+            due = reading_time.timestamp() + cadence + POLL_READING_DELAY
+            if due <= now:
+                # The expected reading is late (no sensor, signal loss...)
+                due = now + POLL_RETRY_INTERVAL
+            # Vendor clocks can't push a connection further than one cadence away
+            due = min(due, now + cadence + POLL_READING_DELAY)
+        self._schedule(conn_id, due + random.uniform(0, POLL_JITTER))
+
+    def failed(self, conn_id):
+        """
+        Schedules a retry with an exponential backoff.
+        """
+        if conn_id not in self._due:
+            return
+        failures = min(self._failures.get(conn_id, 0) + 1, 16)
+        self._failures[conn_id] = failures
+        backoff = min(POLL_INTERVAL * 2 ** (failures - 1), POLL_MAX_BACKOFF)
+        self._schedule(conn_id, time() + backoff * random.uniform(0.8, 1.2))
+
+    def next_due(self):
+        """
+        :return: time of the next fetch, None if nothing is scheduled
+        """
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
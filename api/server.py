@@ -1,30 +1,32 @@
 import hashlib
 import importlib
+import logging
 import os
 import pkgutil
-import threading
 from datetime import datetime, timedelta
 from functools import wraps
-from time import time
+from time import perf_counter
 
 import jwt
-import requests
-from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 from flask import Blueprint, Flask, g, jsonify, make_response, request
 from flask_cors import CORS
-from libre_link_up import LibreLinkUpClient
-from pydexcom import Dexcom
 
 from . import routes
+from .auth_cache import (UnknownUser, get_last_password_change,
+                         start_password_change_listener)
 from .db_conn import get_conn, init_db
-from .influx import init_influx_bucket, write_to_influx
+from .influx import init_influx_bucket
+from .metrics import AUTH_CHECK_SECONDS, AUTH_FAILURES, HTTP_REQUEST_SECONDS
+from .poller import start_in_background as start_poller_in_background
+from .query_cache import start_cgm_write_listener
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 SECRET_KEY = os.getenv("JWT_SECRET")
-FERNET_KEY = os.getenv("FERNET_KEY").encode()
-f = Fernet(FERNET_KEY)
+EMBEDDED_POLLER = os.getenv("EMBEDDED_POLLER", "false").lower() == "true"
 
 package = routes
 
@@ -32,8 +34,8 @@ package = routes
 def create_app(ip: str = "0.0.0.0", port: int = 5000):
     app = Flask(__name__)
     CORS(app, resources={
-         r"/*": {"origins": [os.getenv("FRONTEND_URL", "http://localhost:5173/")]}}, supports_credentials=True)
-    global db_conn
+         r"/*": {"origins": [os.getenv("FRONTEND_URL", "http://localhost:5173/")]}}, supports_credentials=True,
+         expose_headers=["ETag", "X-Next-Cursor"])
 
     for loader, module_name, is_pkg in pkgutil.iter_modules(package.__path__):
         module = importlib.import_module(f"{package.__name__}.{module_name}")
@@ -41,17 +43,13 @@ def create_app(ip: str = "0.0.0.0", port: int = 5000):
             obj = getattr(module, attr)
             if isinstance(obj, Blueprint):
                 app.register_blueprint(obj)
-                print(
-                    f"✅ Routes '{obj.name}' registered from {module_name}.py")
+                logger.info(
+                    "✅ Routes '%s' registered from %s.py", obj.name, module_name)
 
     init_db()
     init_influx_bucket()
-    db_conn = get_conn()
-    actual_data = []
-    last_check_time = int(time())
-
-    dexcom_users = []
-    libre_users = []
+    start_password_change_listener()
+    start_cgm_write_listener()
 
     # print(read_from_influx("123", "glucose"))
 
@@ -65,121 +63,18 @@ def create_app(ip: str = "0.0.0.0", port: int = 5000):
     #     return {'time':last_check_time,
     #             'data':actual_data}
 
-    def actualize_CGM():
-        global actual_data, last_check_time
-        last_check_time = int(time())
-        actual_data = []
-
-        raw_dexcom_users = get_connections_by_type("Dexcom")
-        raw_libre_users = get_connections_by_type("LibreLinkUp")
-
-        # Removing users not in database anymore
-        for user in dexcom_users:
-            if not any(u["user_id"] == user["user_id"] for u in raw_dexcom_users):
-                dexcom_users.remove(user)
-        for user in libre_users:
-            if not any(u["user_id"] == user["user_id"] for u in raw_libre_users):
-                libre_users.remove(user)
-
-        # Adding new users to actualization list
-        for user in raw_dexcom_users:
-            if not any(u["user_id"] == user["user_id"] for u in dexcom_users):
-                region = user['region']
-                if not (user['region'] == 'us' and user['region'] == 'jp'):
-                    region = 'ous'
-                dexcom_users.append({user['id']: Dexcom(
-                    username=user['username'],
-                    password=f.decrypt(user['password'].encode()).decode(),
-                    region=region), "user_id": user["user_id"]})
-        for user in raw_libre_users:
-            if not any(u["user_id"] == user["user_id"] for u in libre_users):
-                libre_users.append({user['id']: LibreLinkUpClient(
-                    username=user['username'],
-                    password=f.decrypt(user['password'].encode()).decode(),
-                    url=f"https://api-{user['region']}.libreview.io",
-                    version="4.14.0",
-                ), "user_id": user["user_id"]})
-
-        # Actualize CGM Data
-        for libre_user in libre_users:
-            for libre_key in libre_user:
-                if type(libre_user[libre_key]) is LibreLinkUpClient:
-                    data = fetch_data_with_relogin(libre_user[libre_key])
-                    if data is not None:
-                        write_to_influx(
-                            measurement="glucose",
-                            tags={
-                                "user_id": libre_user["user_id"], "device": "LibreLinkUp"},
-                            fields={"value": data},
-                        )
-        for dexcom_user in dexcom_users:
-            for dexcom_key in dexcom_user:
-                if type(dexcom_user[dexcom_key]) is Dexcom:
-                    glucose_reading = None
-                    try:
-                        glucose_reading = dexcom_user[dexcom_key].get_current_glucose_reading(
-                        )
-                    except Exception as e:
-                        glucose_reading = None
-                    if glucose_reading is not None:
-                        write_to_influx(
-                            measurement="glucose",
-                            tags={
-                                "user_id": dexcom_user["user_id"], "device": "Dexcom"},
-                            fields={
-                                "value": glucose_reading.mmol},
-                        )
-
-        threading.Timer(60, actualize_CGM).start()
-
-    def get_connections_by_type(conn_type):
-        """
-        Get all the connections coming from the "connections" table that are of the specified type.
-        :param conn_type: string, connection type (ex: "Dexcom", "LibreLinkUp", "Medtronics")
-        :return: dict list
-        """
-        try:
-            with db_conn.cursor() as cur:
-                cur.execute("""
-                    SELECT id, user_id, username, password, type, region
-                    FROM connections
-                    WHERE type = %s
-                """, (conn_type,))
-
-                rows = cur.fetchall()
-                columns = [desc[0] for desc in cur.description]
-
-                results = [dict(zip(columns, row)) for row in rows]
-                return results
-
-        except Exception as e:
-            print(f"❌ Reading error: {e}")
-            return []
+    @app.before_request
+    def start_timer():
+        g.request_start = perf_counter()
 
-    def fetch_data_with_relogin(client: LibreLinkUpClient):
-        try:
-            connection = client.get_raw_connection()
-            return client.get_raw_connection()['glucoseMeasurement']['Value']
-        except Exception as e:
-            if type(e) is requests.HTTPError:
-                if e.response.status_code in (400, 401, 403):
-                    try:
-                        client.login()
-                        connection = client.get_raw_connection()
-                        return connection['glucoseMeasurement']['Value']
-                    except Exception as e:
-                        if type(e) is not KeyError:
-                            print(f'Error: {e}')
-                        else:
-                            return None
-                else:
-                    print(f'Error: {e}')
-                    return None
-            elif type(e) is KeyError:
-                return None
-            else:
-                print(f'Error: {e}')
-                return None
+    @app.after_request
+    def observe_request(response):
+        start = getattr(g, "request_start", None)
+        if start is not None:
+            # Endpoint names, not paths, so that the number of series stays bounded
+            HTTP_REQUEST_SECONDS.labels(request.endpoint or "unknown", request.method,
+                                        str(response.status_code)).observe(perf_counter() - start)
+        return response
 
     @app.before_request
     def auto_refresh_from_remember_me():
@@ -199,14 +94,14 @@ def create_app(ip: str = "0.0.0.0", port: int = 5000):
         try:
             token_hash = hashlib.sha256(raw_token.encode()).hexdigest()
 
-            with db_conn.cursor() as cur:
+            with get_conn() as conn, conn.cursor() as cur:
                 cur.execute(
                     "SELECT r.user_id, r.expires_at, u.email, r.id, r.expires_at FROM remember_tokens r JOIN users u ON r.user_id = u.id WHERE r.token_hash=%s", (token_hash,))
                 result = cur.fetchone()
             if result is None:
                 return jsonify({"error": "User or token does not exist"}), 404
         except Exception as e:
-            print(e)
+            logger.error("❌ Remember me token lookup failed: %s", e)
             return jsonify({"error": "Internal server error"}), 500
 
         user_id, expires_at, email, r_id, r_expires_at = result
@@ -228,12 +123,11 @@ def create_app(ip: str = "0.0.0.0", port: int = 5000):
             new_remember = hashlib.sha256(
                 raw_new_remember.encode()).hexdigest()
             try:
-                with db_conn.cursor() as cur:
+                with get_conn() as conn, conn.cursor() as cur:
                     cur.execute(
                         "UPDATE remember_tokens SET token_hash = %s WHERE id = %s", (new_remember, r_id))
-                db_conn.commit()
             except Exception as e:
-                print(e)
+                logger.error("❌ Remember me token rotation failed: %s", e)
                 return jsonify({"error": "Internal server error"}), 500
 
             request.cookies = request.cookies.to_dict()
@@ -276,7 +170,9 @@ def create_app(ip: str = "0.0.0.0", port: int = 5000):
 
         return response
 
-    actualize_CGM()
+    # Polling normally runs in its own process (poller.py)
+    if EMBEDDED_POLLER:
+        start_poller_in_background()
 
     return app
 
@@ -285,30 +181,38 @@ def create_app(ip: str = "0.0.0.0", port: int = 5000):
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
+        start = perf_counter()
+
+        def reject(reason, message):
+            AUTH_CHECK_SECONDS.observe(perf_counter() - start)
+            AUTH_FAILURES.labels(reason).inc()
+            return jsonify({"error": message}), 401
+
         token = None
 
         if 'opengluco_token' in request.cookies:
             token = request.cookies.get('opengluco_token')
 
         if not token:
-            return jsonify({"error": "Missing token"}), 401
+            return reject("missing", "Missing token")
 
         try:
             payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
         except jwt.ExpiredSignatureError:
-            return jsonify({"error": "Expired token"}), 401
+            return reject("expired", "Expired token")
         except jwt.InvalidTokenError:
-            return jsonify({"error": "Invalid token"}), 401
+            return reject("invalid", "Invalid token")
 
-        with db_conn.cursor() as cur:
-            cur.execute(
-                "SELECT last_password_change FROM users WHERE id=%s", (payload["user_id"],))
-            last_pwd_change = cur.fetchone()[0]
+        try:
+            last_pwd_change = get_last_password_change(payload["user_id"])
+        except UnknownUser:
+            return reject("unknown_user", "Invalid token")
 
         # print(int(last_pwd_change.timestamp()), payload["iat"])
         if last_pwd_change and payload["iat"] < int(last_pwd_change.timestamp()):
-            return jsonify({"error": "Token invalid due to password change"}), 401
+            return reject("password_change", "Token invalid due to password change")
 
+        AUTH_CHECK_SECONDS.observe(perf_counter() - start)
         # Get the payload to the route handler
         return f(payload, *args, **kwargs)
     return decorated
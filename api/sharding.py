@@ -0,0 +1,67 @@
+import hashlib
+import logging
+import os
+import socket
+import uuid
+
+from .db_conn import get_conn
+from .poll_engine import POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# A poller node missing its heartbeats for that long is considered dead and
+# its connections are taken over by the other nodes
+POLLER_NODE_TTL = float(os.getenv("POLLER_NODE_TTL", str(3 * POLL_INTERVAL)))
+
+
+def shard_weight(node_id, conn_id):
+    return hashlib.blake2b(f"{node_id}:{conn_id}".encode(), digest_size=8).digest()
+
+
+def owner(conn_id, nodes):
+    """
+    Rendezvous (highest random weight) hashing: each connection goes to the node
+    with the highest weight for it, so that a node joining or leaving only moves
+    its own share of the connections.
+    :param conn_id: connection id
+    :param nodes: ids of the alive nodes
+    :return: node id
+    """
+    return max(nodes, key=lambda node_id: shard_weight(node_id, conn_id))
+
+
+class NodeMembership:
+    """
+    Lease of a poller node in the "poller_nodes" table, renewed by each heartbeat
+    """
+
+    def __init__(self, node_id=None):
+        self.node_id = node_id or os.getenv(
+            "POLLER_NODE_ID") or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+
+    def heartbeat(self):
+        """
+        Renews the lease of this node and drops the expired ones.
+        :return: sorted list of the alive node ids
+        """
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO poller_nodes (node_id, heartbeat_at) VALUES (%s, now())
+                ON CONFLICT (node_id) DO UPDATE SET heartbeat_at = now()
+            """, (self.node_id,))
+            cur.execute(
+                "DELETE FROM poller_nodes WHERE heartbeat_at < now() - make_interval(secs => %s)",
+                (POLLER_NODE_TTL,))
+            cur.execute("SELECT node_id FROM poller_nodes ORDER BY node_id")
+            return [row[0] for row in cur.fetchall()]
+
+    def leave(self):
+        """
+        Gives the connections of this node back to the others right away
+        """
+        try:
+            with get_conn() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM poller_nodes WHERE node_id = %s", (self.node_id,))
+        except Exception as e:
+            logger.warning("❌ Poller node %s couldn't leave: %s", self.node_id, e)
@@ -0,0 +1,269 @@
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import libre_link_up.client
+import requests
+from libre_link_up import LibreLinkUpClient
+from pydexcom import Dexcom
+
+from .credentials import credentials
+from .db_conn import get_conn
+from .metrics import VENDOR_LOGINS
+
+logger = logging.getLogger(__name__)
+
+# Value (mmol/L), time (aware datetime) and trend of a sensor reading.
+# Trends use the Dexcom scale: 1 DoubleUp, 2 SingleUp, 3 FortyFiveUp, 4 Flat,
+# 5 FortyFiveDown, 6 SingleDown, 7 DoubleDown, 8 NotComputable, None if unknown
+Reading = namedtuple("Reading", ["value", "time", "trend"])
+# LibreLinkUp "TrendArrow" to the Dexcom scale
+LIBRE_TRENDS = {0: 8, 1: 6, 2: 5, 3: 4, 4: 3, 5: 2}
+# LibreLinkUp timestamps look like "8/16/2023 10:16:34 AM"
+LIBRE_TIMESTAMP_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+# (connect, read) timeouts of the vendor HTTP calls: a hung call releases its
+# polling worker instead of holding it forever
+VENDOR_HTTP_TIMEOUT = (float(os.getenv("VENDOR_CONNECT_TIMEOUT", "5")),
+                       float(os.getenv("VENDOR_READ_TIMEOUT", "15")))
+
+
+class TimeoutSession(requests.Session):
+    """
+    requests.Session with a default timeout
+    """
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", VENDOR_HTTP_TIMEOUT)
+        return super().request(*args, **kwargs)
+
+
+class _TimeoutRequests:
+    """
+    Stands for the requests module in libre_link_up.client, that calls
+    requests.get/post without timeout
+    """
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def get(self, *args, **kwargs):
+        kwargs.setdefault("timeout", VENDOR_HTTP_TIMEOUT)
+        return requests.get(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        kwargs.setdefault("timeout", VENDOR_HTTP_TIMEOUT)
+        return requests.post(*args, **kwargs)
+
+
+libre_link_up.client.requests = _TimeoutRequests()
+
+
+class ResumableDexcom(Dexcom):
+    """
+    Dexcom client that doesn't log in when created: it reuses the session
+    persisted in the "connections" table, or logs in on its first call.
+    A new session is only created when Dexcom rejects the current one, and is
+    then reported through `on_session(session_id, account_id)`.
+    """
+
+    def __init__(self, *, session_id=None, on_session=None, **kwargs):
+        self._resumed_session_id = session_id
+        self._on_session = on_session
+        self._creating = True
+        super().__init__(**kwargs)
+        self._session = TimeoutSession()
+
+    def _get_session(self):
+        if self._creating:
+            # Called by Dexcom.__init__: no login yet
+            self._creating = False
+            self._session_id = self._resumed_session_id
+            return
+        super()._get_session()
+        VENDOR_LOGINS.labels("Dexcom").inc()
+        if self._on_session is not None:
+            self._on_session(self._session_id, self._account_id)
+
+    def get_glucose_readings(self, *args, **kwargs):
+        if self._session_id is None:
+            self._get_session()
+        return super().get_glucose_readings(*args, **kwargs)
+
+
+def decrypt(connection, column):
+    """
+    :param connection: row of the "connections" table (dict)
+    :param column: "password" or "token"
+    :return: plain secret, decrypted once per change of the row
+    """
+    return credentials.decrypt(connection.get(column), connection["id"], column)
+
+
+def save_session(conn_id, token, account_id):
+    """
+    Persists a vendor session so that it survives restarts.
+    :param conn_id: id of the row in the "connections" table
+    :param token: session token (encrypted before being stored)
+    :param account_id: vendor account id
+    """
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE connections SET token = %s, account_id = %s WHERE id = %s",
+                (credentials.encrypt(token, conn_id, "token"), account_id, conn_id))
+    except Exception as e:
+        logger.error("❌ Can't save session of connection %s: %s", conn_id, e)
+
+
+def make_dexcom_client(connection):
+    """
+    :param connection: row of the "connections" table (dict)
+    :return: ResumableDexcom
+    """
+    region = connection['region']
+    if not (connection['region'] == 'us' and connection['region'] == 'jp'):
+        region = 'ous'
+
+    # The account id spares the username lookup when a new session is needed
+    user_id = {"account_id": connection["account_id"]} if connection.get(
+        "account_id") else {"username": connection["username"]}
+    return ResumableDexcom(
+        password=decrypt(connection, "password"),
+        region=region,
+        session_id=decrypt(connection, "token"),
+        on_session=lambda token, account_id: save_session(
+            connection["id"], token, account_id),
+        **user_id)
+
+
+def make_libre_client(connection):
+    """
+    :param connection: row of the "connections" table (dict)
+    :return: LibreLinkUpClient, logged in with the persisted session if any
+    """
+    client = LibreLinkUpClient(
+        username=connection['username'],
+        password=decrypt(connection, "password"),
+        url=f"https://api-{connection['region']}.libreview.io",
+        version="4.14.0",
+    )
+    token = decrypt(connection, "token")
+    if token:
+        client.jwt_token = token
+        client.headers["authorization"] = f"Bearer {token}"
+        if connection.get("account_id"):
+            client.headers["Account-Id"] = connection["account_id"]
+    return client
+
+
+def libre_login(client: LibreLinkUpClient, conn_id=None):
+    client.login()
+    VENDOR_LOGINS.labels("LibreLinkUp").inc()
+    if conn_id is not None:
+        save_session(conn_id, client.jwt_token,
+                     client.headers.get("Account-Id"))
+
+
+def fetch_dexcom_data(client: Dexcom, conn_id=None):
+    """
+    :return: current Reading, None if there's none (errors are raised)
+    """
+    glucose_reading = client.get_current_glucose_reading()
+    if glucose_reading is None:
+        return None
+    trend = glucose_reading.trend
+    return Reading(glucose_reading.mmol, glucose_reading.datetime, trend if 0 < trend < 9 else None)
+
+
+def reading_fields(reading):
+    """
+    :return: InfluxDB fields of a Reading
+    """
+    fields = {"value": reading.value}
+    if reading.trend is not None:
+        fields["trend"] = reading.trend
+    return fields
+
+
+def libre_reading(measurement):
+    """
+    :param measurement: raw LibreLinkUp measurement ("glucoseMeasurement" or "graphData" item)
+    :return: Reading
+    """
+    # "FactoryTimestamp" is UTC, "Timestamp" is the local time of the sensor
+    time = datetime.strptime(measurement['FactoryTimestamp'], LIBRE_TIMESTAMP_FORMAT).replace(
+        tzinfo=timezone.utc)
+    # Whole values come as JSON integers: written as is, they would conflict
+    # with the float field of the other readings
+    return Reading(float(measurement['Value']), time, LIBRE_TRENDS.get(measurement.get('TrendArrow')))
+
+
+def fetch_data_with_relogin(client: LibreLinkUpClient, conn_id=None):
+    """
+    Returns the current glucose reading of a LibreLinkUp connection, logging in
+    only when there's no session yet or when it has been rejected.
+    :param client: LibreLinkUpClient
+    :param conn_id: id of the connection, to persist the new session
+    :return: Reading, None if there's none (errors are raised)
+    """
+    try:
+        if client.jwt_token is None:
+            libre_login(client, conn_id)
+        return libre_reading(client.get_raw_connection()['glucoseMeasurement'])
+    except requests.HTTPError as e:
+        if e.response.status_code not in (400, 401, 403):
+            raise
+        # Session rejected: log in again, once
+        try:
+            libre_login(client, conn_id)
+            return libre_reading(client.get_raw_connection()['glucoseMeasurement'])
+        except KeyError:
+            return None
+    except KeyError:
+        # No current measurement
+        return None
+
+
+def fetch_dexcom_history(client: Dexcom, conn_id=None):
+    """
+    :return: list of the Readings of the last 24 hours (errors are raised)
+    """
+    return [Reading(glucose_reading.mmol, glucose_reading.datetime,
+                    glucose_reading.trend if 0 < glucose_reading.trend < 9 else None)
+            for glucose_reading in client.get_glucose_readings(minutes=1440, max_count=288)]
+
+
+def fetch_libre_history(client: LibreLinkUpClient, conn_id=None):
+    """
+    :return: list of the Readings of the LibreLinkUp graph, about the last 12 hours (errors are raised)
+    """
+    if client.jwt_token is None:
+        libre_login(client, conn_id)
+    try:
+        graph = client.get_raw_graph_readings()
+    except requests.HTTPError as e:
+        if e.response.status_code not in (400, 401, 403):
+            raise
+        libre_login(client, conn_id)
+        graph = client.get_raw_graph_readings()
+
+    measurements = list(graph['data'].get('graphData') or [])
+    current = graph['data'].get('connection', {}).get('glucoseMeasurement')
+    if current:
+        measurements.append(current)
+    return [libre_reading(measurement) for measurement in measurements]
+
+
+# History fetch function of each connection type (see api/backfill.py)
+HISTORY = {
+    "Dexcom": fetch_dexcom_history,
+    "LibreLinkUp": fetch_libre_history,
+}
+
+# Client factory and fetch function of each polled connection type
+VENDORS = {
+    "Dexcom": (make_dexcom_client, fetch_dexcom_data),
+    "LibreLinkUp": (make_libre_client, fetch_data_with_relogin),
+}
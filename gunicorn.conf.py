@@ -0,0 +1,18 @@
+import os
+import shutil
+
+# Loaded by gunicorn from the working directory.
+# The metrics of the workers are shared through this directory (see api/metrics.py)
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", "/tmp/opengluco-metrics")
+
+
+def on_starting(server):
+    # Files left by a previous run would be added to the new counters
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,27 @@
+import os
+import signal
+import threading
+
+from api.db_conn import init_db
+from api.influx import init_influx_bucket
+from api.logging_setup import setup_logging
+from api.metrics import start_metrics_server
+from api.poller import run
+
+# Port of the poller's /metrics, 0 to disable
+POLLER_METRICS_PORT = int(os.getenv("POLLER_METRICS_PORT", "9101"))
+
+setup_logging("poller")
+
+if __name__ == "__main__":
+    if POLLER_METRICS_PORT:
+        start_metrics_server(POLLER_METRICS_PORT)
+    init_db()
+    init_influx_bucket(seed=True)
+
+    # docker stop: leave the poller nodes so that the others take the share
+    # of this one over right away, and flush the points still queued
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    run(stop)